@@ -0,0 +1,256 @@
+"""drg 基准测试：生成与真实存档行布局一致的合成存档，测量各阶段耗时，结果以 JSON 输出
+
+用法:
+    python bench.py                                   # 测试同目录的 drg.py
+    python bench.py --drg ../1.10/drg.py              # 测试旧版本，用于对比 1.00 -> 1.10 -> 1.20
+    python bench.py --files 10 100 --lines 2000 20000 --edits 9 60 --out bench.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+import drg as layouts_source
+
+
+CHAPTERS = ("filech1", "filech2", "filech3", "filech4")
+
+
+def load_drg(path):
+    """按路径加载要测试的 drg.py（可以是任意版本）"""
+    if os.path.samefile(path, layouts_source.__file__):
+        # 同目录的 drg 直接复用已导入的模块，进程池子进程才能按模块名找到任务函数
+        return layouts_source
+    spec = importlib.util.spec_from_file_location(f"drg_under_test_{abs(hash(path))}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_save(chapter, total_lines, rng):
+    """生成一个合成存档：前 16 行全局数据、5 个角色属性块与真实布局一致，其余行为标志位数字"""
+    layout = layouts_source.CHAPTER_LAYOUTS[chapter]
+    lines = [str(rng.randint(0, 999)) for _ in range(total_lines)]
+    
+    lines[0] = "Kris"
+    for i in range(1, 7):
+        lines[i] = rng.choice(["", "Susie", "Ralsei", "Noelle"])
+    for field, line_number in layout.fields.items():
+        if line_number <= total_lines:
+            if field.endswith(("hp", "maxhp")):
+                lines[line_number - 1] = str(rng.randint(90, 200))
+            elif field.endswith("weaponstyle"):
+                lines[line_number - 1] = rng.choice(["SWORD", "AXE", "SCARF"])
+            else:
+                lines[line_number - 1] = str(rng.randint(0, 30))
+    # 少量浮点数和负数，接近真实存档（不覆盖布局中的字段，保持属性块的结构）
+    free = sorted(set(range(16, total_lines)) - {line_number - 1 for line_number in layout.fields.values()})
+    for _ in range(total_lines // 50):
+        lines[rng.choice(free)] = f"{rng.randint(0, 99)}.{rng.randint(0, 99)}"
+        lines[rng.choice(free)] = f"-{rng.randint(1, 99)}"
+    
+    return "\r\n".join(lines) + "\r\n"
+
+
+def make_modifications(chapter, edits, total_lines):
+    """生成章节修改表：先改各角色的 hp/maxhp/at（与 drg.json 一致），不够再均匀补充其他行"""
+    layout = layouts_source.CHAPTER_LAYOUTS[chapter]
+    targets = []
+    for member in layouts_source.MEMBERS[:3]:
+        for field in ("hp", "maxhp", "at"):
+            targets.append(layout.fields[f"{member}.{field}"])
+    
+    step = max(1, total_lines // max(1, edits))
+    line_number = 1
+    while len(targets) < edits and line_number <= total_lines:
+        if line_number not in targets:
+            targets.append(line_number)
+        line_number += step
+    
+    return {str(line_number): "9999" for line_number in sorted(targets[:edits])}
+
+
+def populate(save_path, files_per_chapter, total_lines, seed=0):
+    """在目录中生成 filech1_0 ... filech4_K"""
+    rng = random.Random(seed)
+    os.makedirs(save_path, exist_ok=True)
+    for chapter in CHAPTERS:
+        for slot in range(files_per_chapter):
+            with open(os.path.join(save_path, f"{chapter}_{slot}"), 'w', encoding='utf-8', newline='') as f:
+                f.write(make_save(chapter, total_lines, rng))
+
+
+def compile_for(module, config):
+    """新版本使用编译后的 PatchPlan，旧版本直接使用修改表"""
+    if hasattr(module, "compile_config"):
+        plans, _ = module.compile_config(json.dumps(config).encode('utf-8'))
+        return plans
+    return config
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(setup, run, repeat):
+    """每轮先 setup（不计时）再 run，返回最短耗时（秒）"""
+    best = None
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        with quiet():
+            run(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_case(module, workdir, files, total_lines, edits, repeat, engines):
+    """对一组 (存档数, 行数, 修改数) 运行全部基准，返回结果列表"""
+    config = {chapter: make_modifications(chapter, edits, total_lines) for chapter in CHAPTERS}
+    plans = compile_for(module, config)
+    total_files = files * len(CHAPTERS)
+    results = []
+    
+    def fresh():
+        save_path = os.path.join(workdir, "saves")
+        shutil.rmtree(save_path, ignore_errors=True)
+        populate(save_path, files, total_lines)
+        return save_path
+    
+    def record(name, seconds, count=total_files):
+        results.append({
+            "bench": name,
+            "files": total_files,
+            "lines": total_lines,
+            "edits": edits,
+            "seconds": round(seconds, 6),
+            "per_file_ms": round(seconds * 1000 / max(1, count), 4),
+        })
+    
+    save_path = fresh()
+    
+    record("find_save_files", timed(
+        lambda: save_path,
+        lambda path: [module.find_save_files(chapter, path) for chapter in CHAPTERS],
+        repeat))
+    
+    if hasattr(module, "scan_save_dir"):
+        record("scan_save_dir", timed(
+            lambda: save_path,
+            lambda path: module.scan_save_dir(path, CHAPTERS),
+            repeat))
+    
+    with open(os.path.join(save_path, "filech2_0"), encoding='utf-8', newline='') as f:
+        content = f.read()
+    
+    def chained_modify_line(_):
+        modified = content
+        for line_str, value in config["filech2"].items():
+            modified = module.modify_line(modified, int(line_str), value)
+    
+    record("modify_line", timed(lambda: None, chained_modify_line, repeat), count=1)
+    
+    if hasattr(module, "apply_plan"):
+        record("apply_plan", timed(
+            lambda: None, lambda _: module.apply_plan(content, plans["filech2"]), repeat), count=1)
+    
+    def process_all(path):
+        for chapter in CHAPTERS:
+            names, actual_path = module.find_save_files(chapter, path)
+            for name in names:
+                module.process_file(name, plans[chapter], actual_path)
+    
+    record("process_file", timed(fresh, process_all, repeat))
+    
+    def backup_all(path):
+        for chapter in CHAPTERS:
+            for name in module.find_save_files(chapter, path)[0]:
+                module.backup_file(name, path)
+    
+    record("backup_file", timed(fresh, backup_all, repeat))
+    
+    # 旧版本的恢复需要交互确认，只测试支持 assume_yes 的版本
+    restore_all = getattr(module, "restore_all_backups", None)
+    if restore_all is not None and "assume_yes" in restore_all.__code__.co_varnames:
+        def patched():
+            path = fresh()
+            with quiet():
+                process_all(path)
+            return path
+        
+        record("restore_all_backups", timed(
+            patched, lambda path: restore_all(path, assume_yes=True), repeat))
+    
+    for engine in engines:
+        required, run = ENGINES[engine]
+        if hasattr(module, required):
+            record(f"engine:{engine}", timed(fresh, lambda path: run(module, plans, path), repeat))
+    
+    return results
+
+
+# 整目录处理的各种实现: 名称 -> (drg 中需要存在的函数, 调用方式)，新增引擎时在这里登记
+ENGINES = {
+    "memory": ("run_batch", lambda m, plans, path: m.run_batch(plans, [path], workers=1)),
+    "stream": ("run_batch", lambda m, plans, path: m.run_batch(plans, [path], workers=1, stream=True)),
+    "inplace": ("run_batch", lambda m, plans, path: m.run_batch(plans, [path], workers=1, inplace=True)),
+    "process-pool": ("run_batch", lambda m, plans, path: m.run_batch(plans, [path], workers=None)),
+    "vector": ("vector_patch", lambda m, plans, path: m.run_batch(plans, [path], workers=1, vectorize=True)),
+    "vector-pool": ("vector_patch", lambda m, plans, path: m.run_batch(plans, [path], workers=None,
+                                                                      vectorize=True)),
+    "async": ("run_pipeline", lambda m, plans, path: m.run_pipeline(plans, [path])),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="drg 基准测试，结果以 JSON 输出")
+    parser.add_argument("--drg", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "drg.py"),
+                        help="要测试的 drg.py 路径（默认: 同目录的 drg.py）")
+    parser.add_argument("--files", type=int, nargs="+", default=[5, 50], metavar="N",
+                        help="每个章节的存档数（默认: 5 50）")
+    parser.add_argument("--lines", type=int, nargs="+", default=[1000, 10000], metavar="N",
+                        help="每个存档的行数，至少 300（默认: 1000 10000）")
+    parser.add_argument("--edits", type=int, nargs="+", default=[9, 60], metavar="N",
+                        help="每个存档修改的行数（默认: 9 60）")
+    parser.add_argument("--engines", nargs="*", default=list(ENGINES), choices=list(ENGINES),
+                        help="要测试的整目录处理引擎（默认: 全部）")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数，取最短耗时（默认: 3）")
+    parser.add_argument("--out", default="-", help="结果输出文件，- 表示标准输出（默认: -）")
+    args = parser.parse_args(argv)
+    
+    module = load_drg(os.path.abspath(args.drg))
+    results = []
+    with tempfile.TemporaryDirectory(prefix="drg-bench-") as workdir:
+        for files in args.files:
+            for total_lines in args.lines:
+                for edits in args.edits:
+                    results.extend(bench_case(module, workdir, files, max(300, total_lines),
+                                              edits, args.repeat, args.engines))
+    
+    report = json.dumps({
+        "drg": os.path.abspath(args.drg),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }, ensure_ascii=False, indent=2)
+    
+    if args.out == "-":
+        print(report)
+    else:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,62 +3,26 @@ import os
 import glob
 import re
 import sys
-import ctypes
-import shutil
-from ctypes import wintypes
-
-# Windows API 常量
-OFN_FILEMUSTEXIST = 0x00001000
-OFN_NOCHANGEDIR = 0x00000008
-
-# 定义 OPENFILENAME 结构
-class OPENFILENAME(ctypes.Structure):
-    _fields_ = [
-        ("lStructSize", wintypes.DWORD),
-        ("hwndOwner", wintypes.HWND),
-        ("hInstance", wintypes.HINSTANCE),
-        ("lpstrFilter", wintypes.LPCWSTR),
-        ("lpstrCustomFilter", wintypes.LPWSTR),
-        ("nMaxCustFilter", wintypes.DWORD),
-        ("nFilterIndex", wintypes.DWORD),
-        ("lpstrFile", wintypes.LPWSTR),
-        ("nMaxFile", wintypes.DWORD),
-        ("lpstrFileTitle", wintypes.LPWSTR),
-        ("nMaxFileTitle", wintypes.DWORD),
-        ("lpstrInitialDir", wintypes.LPCWSTR),
-        ("lpstrTitle", wintypes.LPCWSTR),
-        ("Flags", wintypes.DWORD),
-        ("nFileOffset", wintypes.WORD),
-        ("nFileExtension", wintypes.WORD),
-        ("lpstrDefExt", wintypes.LPCWSTR),
-        ("lCustData", wintypes.LPARAM),
-        ("lpfnHook", wintypes.LPVOID),
-        ("lpTemplateName", wintypes.LPCWSTR),
-        ("pvReserved", wintypes.LPVOID),
-        ("dwReserved", wintypes.DWORD),
-        ("FlagsEx", wintypes.DWORD),
-    ]
-
-def select_file_dialog(title="选择 drg.json 配置文件", filter_text="JSON文件\0*.json\0所有文件\0*.*\0"):
-    """使用 Windows API 弹出文件选择对话框"""
-    buffer_size = 260
-    file_buffer = ctypes.create_unicode_buffer(buffer_size)
-    
-    ofn = OPENFILENAME()
-    ofn.lStructSize = ctypes.sizeof(OPENFILENAME)
-    ofn.hwndOwner = None
-    ofn.lpstrFilter = filter_text
-    ofn.lpstrFile = ctypes.cast(file_buffer, wintypes.LPWSTR)
-    ofn.nMaxFile = buffer_size
-    ofn.lpstrTitle = title
-    ofn.Flags = OFN_FILEMUSTEXIST | OFN_NOCHANGEDIR
-    
-    comdlg32 = ctypes.windll.comdlg32
-    result = comdlg32.GetOpenFileNameW(ctypes.byref(ofn))
-    
-    if result:
-        return file_buffer.value
-    return None
+import hashlib
+import itertools
+import time
+from array import array
+from collections import namedtuple
+from functools import lru_cache, partial
+
+# 配置文件选择器中可选的文件类型
+CONFIG_PATTERNS = (("JSON文件", "*.json"), ("所有文件", "*.*"))
+
+
+def select_file_dialog(title="选择 drg.json 配置文件", patterns=CONFIG_PATTERNS, picker=None):
+    """弹出文件选择器，返回所选文件路径，取消时返回 None
+    
+    选择器在 drg_dialog 模块中，只有走到这里才导入（启动时不加载 ctypes）。
+    picker 为选择器名称 windows/terminal/none，默认按平台选择（见 drg_dialog.default_picker_name）。
+    """
+    import drg_dialog
+    
+    return drg_dialog.get_picker(picker)(title, patterns)
 
 
 def get_exe_dir():
@@ -71,186 +35,2401 @@ def get_exe_dir():
         return os.path.dirname(os.path.abspath(__file__))
 
 
-EXE_DIR = get_exe_dir()
+EXE_DIR = get_exe_dir()
+
+
+def load_config(filename="drg.json", picker=None):
+    """从 exe 所在目录加载配置，找不到则提示选择或恢复备份；picker 同 select_file_dialog"""
+    config_path = os.path.join(EXE_DIR, filename)
+    
+    if not os.path.exists(config_path):
+        print(f"\n未找到默认配置文件: {config_path}")
+        print("按 1 选择配置文件，按 3 恢复备份，或其他键退出...")
+        
+        try:
+            choice = input("> ").strip()
+        except:
+            choice = ""
+        
+        if choice == "1":
+            selected = select_file_dialog(picker=picker)
+            if selected and os.path.exists(selected):
+                config_path = selected
+                print(f"已选择: {config_path}")
+            else:
+                raise FileNotFoundError("未选择有效文件")
+        elif choice == "3":
+            return None, None, True  # 第三个值标记进入恢复模式
+        else:
+            raise FileNotFoundError("用户取消选择")
+    
+    config, save_path = read_config(config_path)
+    return config, save_path, False
+
+
+def read_config(config_path):
+    """读取并编译指定的配置文件（优先使用编译缓存），返回 (config, save_path)，不做任何交互"""
+    config, settings = compile_config_file(config_path)
+    return config, _resolve_save_path(settings)
+
+
+def read_save_path(config_path):
+    """只读取配置中的 settings.save_path（恢复备份用，修改表有误也不影响恢复），返回存档目录
+    
+    配置不是有效的 JSON 或 settings 格式有误时抛出 ConfigError。
+    """
+    with open(config_path, 'rb') as f:
+        raw = f.read()
+    try:
+        config = json.loads(raw.decode('utf-8'))
+    except ValueError as e:
+        raise ConfigError([f"不是有效的 JSON: {e}"]) from None
+    
+    settings = config.get("settings", {}) if isinstance(config, dict) else None
+    if not isinstance(settings, dict) or not isinstance(settings.get("save_path", ""), str):
+        raise ConfigError(["settings.save_path: 应为字符串"])
+    return _resolve_save_path(settings)
+
+
+def _resolve_save_path(settings):
+    """settings.save_path 的完整路径，相对路径相对于程序目录"""
+    save_path = settings.get("save_path", "./")
+    
+    if not os.path.isabs(save_path):
+        save_path = os.path.join(EXE_DIR, save_path)
+    
+    return os.path.normpath(save_path)
+
+
+# 一次扫描存档目录的分类结果
+#   saves:   {章节: [存档文件名, ...]}，按存档位编号排序
+#   backups: 旧版本留下的 <存档>.backup 文件完整路径列表
+DirIndex = namedtuple("DirIndex", ["save_path", "saves", "backups"])
+
+
+@lru_cache(maxsize=None)
+def _save_name_matcher(chapter_keys):
+    """所有章节共用的预编译正则 ^(章节1|章节2|...)_(\d+)$，章节名经过转义"""
+    alternation = "|".join(re.escape(key) for key in chapter_keys)
+    return re.compile(rf"^({alternation})_(\d+)$")
+
+
+def scan_save_dir(save_path, chapter_keys):
+    """用一次 os.scandir 把目录里的文件分成各章节存档和 .backup 文件，返回 DirIndex
+    
+    目录不存在或无法读取（如没有权限）时返回空结果，与旧版 glob 一致，一个坏目录不会中断整批处理。
+    """
+    chapter_keys = tuple(chapter_keys)
+    matcher = _save_name_matcher(chapter_keys)
+    found = {key: [] for key in chapter_keys}
+    backups = []
+    
+    try:
+        with os.scandir(save_path) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith("."):
+                    continue
+                if name.endswith(".backup"):
+                    if entry.is_file():
+                        backups.append(entry.path)
+                    continue
+                match = matcher.match(name) if chapter_keys else None
+                if match and entry.is_file():
+                    found[match.group(1)].append((int(match.group(2)), name))
+    except OSError:
+        return DirIndex(save_path, {key: [] for key in chapter_keys}, [])
+    
+    saves = {key: [name for _, name in sorted(files)] for key, files in found.items()}
+    return DirIndex(save_path, saves, sorted(backups))
+
+
+def find_save_files(base_name, save_path):
+    """在指定目录查找存档文件"""
+    return scan_save_dir(save_path, (base_name,)).saves[base_name], save_path
+
+
+def find_backup_files(save_path):
+    """查找所有备份文件"""
+    return scan_save_dir(save_path, ()).backups
+
+
+def _temp_path_for(path, mode_from=None):
+    """在目标文件同目录创建临时文件（同一文件系统，保证 os.replace 是原子的）"""
+    import shutil
+    import tempfile
+    
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory or ".")
+    os.close(fd)
+    
+    # mkstemp 创建的文件权限是 0600，沿用原文件（或 mode_from 指定文件）的权限
+    mode_from = path if os.path.exists(path) else mode_from
+    if mode_from:
+        shutil.copymode(mode_from, temp_path)
+    return temp_path
+
+
+def _replace_synced(temp_path, path):
+    """fsync 临时文件后原子替换目标文件；失败时清理临时文件"""
+    try:
+        fd = os.open(temp_path, os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def atomic_write(path, data, mode_from=None):
+    """崩溃安全地写入字节：临时文件 -> fsync -> os.replace
+    
+    目录项的 fsync 不在这里做，由调用方处理完整个目录后调用一次 fsync_dir。
+    """
+    temp_path = _temp_path_for(path, mode_from)
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    _replace_synced(temp_path, path)
+
+
+def atomic_copy(src, dst):
+    """崩溃安全地复制文件（保留时间戳等元数据，同 shutil.copy2）"""
+    import shutil
+    
+    temp_path = _temp_path_for(dst)
+    try:
+        shutil.copyfile(src, temp_path)
+        shutil.copystat(src, temp_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    _replace_synced(temp_path, dst)
+
+
+def fsync_dir(path):
+    """fsync 目录，让目录内的 os.replace 落盘；每个存档目录处理完后调用一次
+    
+    Windows 不支持对目录 fsync，直接跳过。
+    """
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# 备份仓库：存档目录下的隐藏目录，按 SHA-256 存放备份内容，相同内容只存一份
+#   objects/<sha256>  备份内容
+#   manifest.json     每次备份的版本记录 {"file", "time", "sha256", "size"}，按时间从旧到新
+#   journal/*.json    尚未并入 manifest 的版本记录，每个备份一条，在替换存档之前写入；
+#                     运行中途被中断时备份仍能找到，下次写 manifest 或规划恢复时并入
+BACKUP_DIRNAME = ".drg_backups"
+MANIFEST_FILENAME = "manifest.json"
+JOURNAL_DIRNAME = "journal"
+
+# 同一进程内日志文件名的序号（同一纳秒内写入多条时保证不重名）
+_JOURNAL_SEQ = itertools.count()
+
+
+def _backup_object_path(save_path, digest):
+    return os.path.join(save_path, BACKUP_DIRNAME, "objects", digest)
+
+
+def load_backup_manifest(save_path):
+    """读取备份版本记录列表，不存在或损坏时返回空列表"""
+    try:
+        with open(os.path.join(save_path, BACKUP_DIRNAME, MANIFEST_FILENAME), 'rb') as f:
+            manifest = json.loads(f.read().decode('utf-8'))
+        return list(manifest.get("generations", []))
+    except (OSError, ValueError, AttributeError):
+        return []
+
+
+def journal_backup(save_path, record):
+    """把一条备份记录写入日志（必须在替换存档之前调用），目录 fsync 由 commit_save_dir 统一做"""
+    directory = os.path.join(save_path, BACKUP_DIRNAME, JOURNAL_DIRNAME)
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.time_ns():020d}-{os.getpid()}-{next(_JOURNAL_SEQ)}.json"
+    atomic_write(os.path.join(directory, name), json.dumps(record, ensure_ascii=False).encode('utf-8'))
+
+
+def _load_backup_journal(save_path):
+    """读取尚未并入 manifest 的日志，返回 [(日志路径, 版本记录), ...]，按写入顺序；损坏的日志跳过"""
+    directory = os.path.join(save_path, BACKUP_DIRNAME, JOURNAL_DIRNAME)
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    except OSError:
+        return []
+    
+    entries = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            with open(path, 'rb') as f:
+                record = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            continue
+        if isinstance(record, dict) and "file" in record and "sha256" in record:
+            entries.append((path, record))
+    return entries
+
+
+def _merge_generations(generations, records):
+    """把 records 追加到 generations（就地）；与该存档最新一版内容相同的记录不重复追加"""
+    latest = {}
+    for record in generations:
+        latest[record["file"]] = record["sha256"]
+    
+    for record in records:
+        if latest.get(record["file"]) != record["sha256"]:
+            generations.append(record)
+            latest[record["file"]] = record["sha256"]
+
+
+def append_backup_generations(save_path, records):
+    """把日志中的记录和本次的备份记录追加到 manifest，写入后删除已并入的日志"""
+    journal = _load_backup_journal(save_path)
+    generations = load_backup_manifest(save_path)
+    _merge_generations(generations, [record for _, record in journal])
+    _merge_generations(generations, records)
+    
+    data = json.dumps({"version": 1, "generations": generations}, ensure_ascii=False, indent=1)
+    atomic_write(os.path.join(save_path, BACKUP_DIRNAME, MANIFEST_FILENAME), data.encode('utf-8'))
+    
+    for path, _ in journal:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def list_backup_generations(save_path):
+    """{存档文件名: [版本记录, ...]}，每个存档的版本按时间从旧到新（包括尚未并入 manifest 的日志）"""
+    generations = load_backup_manifest(save_path)
+    _merge_generations(generations, [record for _, record in _load_backup_journal(save_path)])
+    history = {}
+    for record in generations:
+        history.setdefault(record["file"], []).append(record)
+    return history
+
+
+def backup_file(file_path, save_path):
+    """创建备份（写入备份仓库并追加一条版本记录）"""
+    record = _write_backup(os.path.join(save_path, file_path))
+    append_backup_generations(save_path, [record])
+    print(f"  已备份: {file_path} ({record['sha256'][:12]})")
+    return record
+
+
+def _read_bytes(path):
+    """读取整个文件，返回 (内容, stat)"""
+    with open(path, 'rb') as f:
+        return f.read(), os.fstat(f.fileno())
+
+
+def _write_backup(full_path, data=None):
+    """把存档原字节存入备份仓库并写一条日志（见 journal_backup），不输出任何内容，返回版本记录
+    
+    data 为已读入内存的存档内容时直接使用，不再读一遍磁盘。
+    内容已在仓库中（其他章节/存档位或之前的运行存过）时不再写入。
+    返回后即使进程被中断，备份也能被恢复找到；版本记录由 commit_save_dir 并入 manifest。
+    """
+    if data is None:
+        data, _ = _read_bytes(full_path)
+    
+    save_path, file_path = os.path.split(full_path)
+    digest = hashlib.sha256(data).hexdigest()
+    object_path = _backup_object_path(save_path, digest)
+    
+    if not os.path.exists(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        atomic_write(object_path, data, mode_from=full_path)
+    
+    record = _backup_record(file_path, digest, len(data))
+    journal_backup(save_path, record)
+    return record
+
+
+def _backup_record(file_path, digest, size):
+    return {
+        "file": file_path,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sha256": digest,
+        "size": size,
+    }
+
+
+def restore_backup(file_path, save_path, generation=-1, history=None):
+    """从备份恢复
+    
+    generation 是该存档版本列表的下标：-1 为最近一次备份，0 为最早（最原始）的一次。
+    history 为 list_backup_generations 的结果，批量恢复时传入以免重复读取 manifest。
+    备份仓库中没有该存档时，退回旧版本留下的 <存档>.backup。
+    """
+    if history is None:
+        history = list_backup_generations(save_path)
+    task, warning = _restore_task(file_path, save_path, generation, history)
+    
+    if task is None:
+        print(f"  警告: {warning}")
+        return False
+    
+    # 先复制到同目录临时文件再原子替换，恢复中途崩溃也不会损坏当前存档
+    atomic_copy(task.source, os.path.join(save_path, file_path))
+    
+    print(f"  已恢复: {file_path}")
+    return True
+
+
+# 一个待执行的恢复：把 source 复制回存档 file；sha256/size 为备份内容的哈希和大小（旧 .backup 为 None）
+RestoreTask = namedtuple("RestoreTask", ["file", "source", "sha256", "size"])
+
+
+def _restore_task(file_path, save_path, generation, history):
+    """确定某个存档要从哪个备份恢复，返回 (RestoreTask, None) 或 (None, 警告信息)"""
+    generations = history.get(file_path)
+    
+    if generations:
+        try:
+            record = generations[generation]
+        except IndexError:
+            return None, f"{file_path} 只有 {len(generations)} 个备份版本，没有第 {generation} 版"
+        task = RestoreTask(file_path, _backup_object_path(save_path, record["sha256"]),
+                           record["sha256"], record.get("size"))
+    else:
+        task = RestoreTask(file_path, os.path.join(save_path, f"{file_path}.backup"), None, None)
+    
+    if not os.path.exists(task.source):
+        return None, f"无备份文件 {os.path.basename(task.source)}"
+    return task, None
+
+
+def _file_sha256(path):
+    """分块计算文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _run_restore_task(save_path, task):
+    """执行单个恢复，返回 "restored"（已恢复）或 "identical"（存档已与备份一致，跳过）"""
+    full_path = os.path.join(save_path, task.file)
+    
+    try:
+        st = os.stat(full_path)
+    except FileNotFoundError:
+        st = None
+    
+    # 大小不同时一定不一致，不必计算哈希
+    if st is not None and (task.size is None or task.size == st.st_size):
+        expected = task.sha256 or _file_sha256(task.source)
+        if _file_sha256(full_path) == expected:
+            return "identical"
+    
+    atomic_copy(task.source, full_path)
+    return "restored"
+
+
+def restore_many(save_path, tasks, workers=None):
+    """用线程池并行执行一批恢复，返回 [(文件名, 状态, 错误信息), ...]，顺序与 tasks 一致
+    
+    状态为 "restored" / "identical" / "error"。workers 为 None 时由线程池自行决定线程数。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def run(task):
+        try:
+            return task.file, _run_restore_task(save_path, task), None
+        except Exception as e:
+            return task.file, "error", str(e)
+    
+    if workers == 1 or len(tasks) <= 1:
+        return [run(task) for task in tasks]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, tasks))
+
+
+def plan_restore(save_path, generation=-1):
+    """规划一个存档目录的恢复，不输出任何内容
+    
+    返回 (有备份的存档名列表, 版本历史, [RestoreTask, ...], [(存档名, 警告信息), ...])；
+    存档名包括备份仓库中的存档和旧版本留下的 .backup 文件。
+    上次运行中途被中断留下的日志先并入 manifest（写不进去时照样从日志中读取）。
+    """
+    if _load_backup_journal(save_path):
+        try:
+            append_backup_generations(save_path, [])
+        except OSError:
+            pass
+    history = list_backup_generations(save_path)
+    backup_files = sorted(history)
+    for bf in find_backup_files(save_path):
+        original_name = os.path.basename(bf)[:-len(".backup")]
+        if original_name not in history:
+            backup_files.append(original_name)
+    
+    tasks = []
+    warnings = []
+    for original_name in backup_files:
+        task, warning = _restore_task(original_name, save_path, generation, history)
+        if task is None:
+            warnings.append((original_name, warning))
+        else:
+            tasks.append(task)
+    return backup_files, history, tasks, warnings
+
+
+def finish_restore(save_path, results):
+    """恢复完成后落盘：从目录索引中去掉已恢复的存档，再 fsync 目录；results 为 restore_many 的结果"""
+    restored = [name for name, status, _ in results if status == "restored"]
+    if restored:
+        # 恢复后的内容不再是索引里记录的修改结果
+        index = load_patch_index(save_path)
+        for name in restored:
+            index.pop(name, None)
+        save_patch_index(save_path, index)
+    fsync_dir(save_path)
+
+
+def commit_save_dir(save_path, index, results):
+    """把一个存档目录本次的处理结果落盘
+    
+    更新目录索引、把备份日志和版本记录并入 manifest，最后对目录做一次 fsync（每个目录一次，而不是每个文件一次）。
+    index 是该目录的索引表，会被就地更新。没有任何结果（如目录无法读取）时不做任何事。
+    """
+    if not results or not os.path.isdir(save_path):
+        return
+    
+    index_changed = False
+    records = []
+    for result in results:
+        if result.index_entry is not None and index.get(result.file) != result.index_entry:
+            index[result.file] = result.index_entry
+            index_changed = True
+        if result.backup is not None:
+            records.append(result.backup)
+    
+    if index_changed:
+        save_patch_index(save_path, index)
+    if records or _load_backup_journal(save_path):
+        append_backup_generations(save_path, records)
+        fsync_dir(os.path.join(save_path, BACKUP_DIRNAME, "objects"))
+        fsync_dir(os.path.join(save_path, BACKUP_DIRNAME, JOURNAL_DIRNAME))
+        fsync_dir(os.path.join(save_path, BACKUP_DIRNAME))
+    fsync_dir(save_path)
+
+
+# 匹配行内第一个数字（含负号和小数部分；预编译一次，所有修改共用）
+# 只认 ASCII 数字：str 版本的 \d 还会匹配全角等 Unicode 数字，与 bytes 版本不一致
+NUMBER_RE = re.compile(r'-?[0-9]+\.?[0-9]*')
+# 流式修改按字节处理，使用同一规则的 bytes 版本
+NUMBER_BYTES_RE = re.compile(rb'-?[0-9]+\.?[0-9]*')
+
+
+def modify_line(content, line_number, new_value):
+    """修改指定行的数字（新值按原数字的格式写入，见 apply_value）"""
+    lines = content.split('\n')
+    target_index = line_number - 1
+    
+    if target_index < 0 or target_index >= len(lines):
+        print(f"  警告: 行号 {line_number} 超出范围 (共 {len(lines)} 行)")
+        return content
+    
+    lines[target_index] = apply_value(literal_value(str(new_value)), lines[target_index])
+    
+    return '\n'.join(lines)
+
+
+# 存档布局（按游戏写存档的顺序推出）：
+#   前 16 行是全局数据（名字、队伍、金钱、经验、等级等）；
+#   之后是 5 个角色槽的属性块，0 号槽不用，1-4 号依次是 kris/susie/ralsei/noelle；
+#   每个属性块的前 10 行依次是 hp/maxhp/at/df/mag/guts/武器/防具1/防具2/武器类型，
+#   后面是 4 件装备的附加属性和 12 个法术。第二章起每件装备多了两项附加属性，属性块由 54 行变为 62 行。
+#   属性块之后是物品、1 万个剧情标志位和少量其他数据。
+#   fields:   字段名 -> 行号，如 {"gold": 11, "kris.maxhp": 72}
+#   max_line: 配置中允许的最大行号（比真实存档的行数留有余量，只用来拦截明显写错的行号）
+SaveLayout = namedtuple("SaveLayout", ["name", "member_block", "fields", "max_line"])
+
+HEADER_FIELDS = {"gold": 11, "xp": 12, "lv": 13}
+MEMBER_BASE_LINE = 17
+MEMBERS = ("kris", "susie", "ralsei", "noelle")
+MEMBER_FIELDS = ("hp", "maxhp", "at", "df", "mag", "guts", "weapon", "armor1", "armor2", "weaponstyle")
+EQUIPMENT_SLOTS = 4
+SPELL_SLOTS = 12
+# 属性块之后的行数上限（物品 + 剧情标志位 + 其他）
+SAVE_TAIL_LINES = 11000
+
+
+def _build_layout(name, member_block):
+    """预先算好布局中每个字段所在的行号"""
+    fields = dict(HEADER_FIELDS)
+    for slot, member in enumerate(MEMBERS, start=1):
+        base = MEMBER_BASE_LINE + slot * member_block
+        for offset, field in enumerate(MEMBER_FIELDS):
+            fields[f"{member}.{field}"] = base + offset
+    max_line = MEMBER_BASE_LINE + (len(MEMBERS) + 1) * member_block + SAVE_TAIL_LINES
+    return SaveLayout(name, member_block, fields, max_line)
+
+
+LAYOUTS = {
+    "ch1": _build_layout("ch1", 54),
+    "ch2": _build_layout("ch2", 62),
+}
+
+# 各章节存档使用的布局
+CHAPTER_LAYOUTS = {
+    "filech1": LAYOUTS["ch1"],
+    "filech2": LAYOUTS["ch2"],
+    "filech3": LAYOUTS["ch2"],
+    "filech4": LAYOUTS["ch2"],
+}
+
+
+# 配置中的行号键和数值
+LINE_KEY_RE = re.compile(r'[0-9]+')
+NUMERIC_VALUE_RE = re.compile(r'-?[0-9]+(?:\.[0-9]*)?')
+
+
+# 判断布局需要读取的存档开头行数（覆盖最大的属性块布局的全部角色槽）
+FINGERPRINT_LINES = MEMBER_BASE_LINE + (len(MEMBERS) + 1) * max(layout.member_block for layout in LAYOUTS.values())
+
+
+def _line_shape(line):
+    line = line.strip()
+    if not line:
+        return 0  # 空行
+    return 1 if NUMERIC_VALUE_RE.fullmatch(line) else 2  # 数字 / 文字
+
+
+def fingerprint_layout(lines, default=None):
+    """根据存档开头的行判断存档实际使用的布局，返回 SaveLayout；判断不出时返回 default
+    
+    每个候选布局按自己的属性块长度把 1-4 号角色槽对齐，逐行比较相邻两个槽同一位置的行形态
+    （空行/数字/文字）。只看至少一边不是数字的位置（如每个角色的武器类型）：形态相同加一分，不同减一分。
+    属性块长度与存档一致时这些行逐槽对齐，得分最高；并列（如全是数字）时优先 default。
+    只需要开头 FINGERPRINT_LINES 行。
+    """
+    shapes = [_line_shape(line) for line in lines[:FINGERPRINT_LINES]]
+    best, best_score = default, None
+    
+    for layout in LAYOUTS.values():
+        block = layout.member_block
+        if len(shapes) < MEMBER_BASE_LINE - 1 + (len(MEMBERS) + 1) * block:
+            continue
+        score = 0
+        for slot in range(1, len(MEMBERS)):
+            start = MEMBER_BASE_LINE - 1 + slot * block
+            for a, b in zip(shapes[start:start + block], shapes[start + block:start + 2 * block]):
+                if a != 1 or b != 1:
+                    score += 1 if a == b else -1
+        if best_score is None or score > best_score or (score == best_score and layout is default):
+            best, best_score = layout, score
+    return best
+
+
+@lru_cache(maxsize=None)
+def _member_offset_table(source_name, target_name):
+    """属性块内的偏移换算表：source 布局的偏移 -> target 布局的偏移，target 中没有对应项时为 None
+    
+    前 10 个字段和 12 个法术一一对应；装备附加属性按 (第几件装备, 第几项) 对应，
+    target 中每件装备的附加属性较少时，多出的几项没有对应。
+    """
+    source, target = LAYOUTS[source_name], LAYOUTS[target_name]
+    fields = len(MEMBER_FIELDS)
+    source_attrs = (source.member_block - fields - SPELL_SLOTS) // EQUIPMENT_SLOTS
+    target_attrs = (target.member_block - fields - SPELL_SLOTS) // EQUIPMENT_SLOTS
+    
+    table = []
+    for offset in range(source.member_block):
+        if offset < fields:
+            table.append(offset)
+        elif offset < fields + EQUIPMENT_SLOTS * source_attrs:
+            equipment, attr = divmod(offset - fields, source_attrs)
+            table.append(fields + equipment * target_attrs + attr if attr < target_attrs else None)
+        else:
+            table.append(offset - EQUIPMENT_SLOTS * (source_attrs - target_attrs))
+    return tuple(table)
+
+
+def remap_line(line_number, source, target):
+    """把 source 布局中的行号换算成 target 布局中的行号；target 中没有对应的行时返回 None
+    
+    全局数据（前 16 行）不变；属性块按偏移换算表换算；属性块之后的行整体平移属性块的总长度差。
+    """
+    if line_number < MEMBER_BASE_LINE or source is target:
+        return line_number
+    members_end = MEMBER_BASE_LINE + (len(MEMBERS) + 1) * source.member_block
+    if line_number >= members_end:
+        return line_number + (len(MEMBERS) + 1) * (target.member_block - source.member_block)
+    
+    slot, offset = divmod(line_number - MEMBER_BASE_LINE, source.member_block)
+    mapped = _member_offset_table(source.name, target.name)[offset]
+    return None if mapped is None else MEMBER_BASE_LINE + slot * target.member_block + mapped
+
+
+def resolve_line(chapter, key):
+    """把配置中的键解析为行号：可以是行号（"72"），也可以是字段名（"kris.maxhp"）"""
+    if LINE_KEY_RE.fullmatch(key):
+        return int(key)
+    
+    layout = CHAPTER_LAYOUTS.get(chapter)
+    if layout is None:
+        raise ValueError(f"章节 {chapter} 没有已知的存档布局，不能使用字段名 {key!r}")
+    
+    line_number = layout.fields.get(key)
+    if line_number is None:
+        raise ValueError(f"未知字段 {key!r}（章节 {chapter}，布局 {layout.name}）")
+    return line_number
+
+
+# 计算式：在修改的同一遍处理中，根据行内原有的数字（或其他行的数字）算出新值
+#   +500 / add:500       加（减法写作 add:-500 或 +-500）
+#   *2 / mul:1.5         乘
+#   max:9999 / min:100   不超过 9999 / 不低于 100
+#   @72 / @kris.maxhp    另一行在本次修改前的数字；可作为起始值（"@kris.maxhp"）或运算数（"*@12"）
+#   多步用 | 连接，从左到右计算，如 "*2|max:9999"
+# 纯数字仍是直接写入的字面值（"-3" 表示写入 -3，而不是减 3）。
+# 字面值和计算结果都按原数字的格式输出：原来是整数时四舍五入为整数，原来有小数时保留同样的小数位数。
+# 目标行或引用的行没有数字（或超出存档行数）时，该行不修改。
+#   base: 起始值引用的行号，None 表示目标行自己的数字
+#   ops:  ((运算, (类型, 运算数)), ...)，运算为 add/mul/min/max，类型为 "num"（数字）或 "ref"（行号）
+ValueExpr = namedtuple("ValueExpr", ["source", "base", "ops"])
+
+# 字面值新值（编译时解析一次）
+#   source: 配置中的写法
+#   number: 解析出的 int 或 float
+#   text:   写入整数时的文本；整数写法原样保留，小数写法四舍五入为整数
+LiteralValue = namedtuple("LiteralValue", ["source", "number", "text"])
+
+# 计算式的运算前缀（按此顺序匹配）
+EXPR_OPS = (("add:", "add"), ("mul:", "mul"), ("min:", "min"), ("max:", "max"), ("+", "add"), ("*", "mul"))
+
+
+def _ref_line(chapter, key):
+    """计算式中 @ 之后的行号或字段名，校验规则同配置的键"""
+    line_number = resolve_line(chapter, key)
+    layout = CHAPTER_LAYOUTS.get(chapter)
+    if line_number < 1 or (layout is not None and line_number > layout.max_line):
+        raise ValueError(f"引用的行号 {line_number} 超出范围")
+    return line_number
+
+
+def _parse_operand(chapter, text):
+    if text.startswith("@"):
+        return "ref", _ref_line(chapter, text[1:])
+    if NUMERIC_VALUE_RE.fullmatch(text):
+        return "num", float(text) if "." in text else int(text)
+    raise ValueError(f"无效的运算数 {text!r}")
+
+
+def compile_expr(chapter, source):
+    """把计算式编译成 ValueExpr，格式有误时抛出 ValueError"""
+    segments = [segment.strip() for segment in source.split("|")]
+    base = None
+    if segments[0].startswith("@"):
+        base = _ref_line(chapter, segments[0][1:])
+        segments = segments[1:]
+    
+    ops = []
+    for segment in segments:
+        for prefix, op in EXPR_OPS:
+            if segment.startswith(prefix):
+                ops.append((op, _parse_operand(chapter, segment[len(prefix):])))
+                break
+        else:
+            raise ValueError(f"无法识别 {segment!r}（可用: 数字、+N、*N、add:N、mul:N、min:N、max:N、@行号）")
+    return ValueExpr(source, base, tuple(ops))
+
+
+def literal_value(text):
+    """把数字写法（须符合 NUMERIC_VALUE_RE）编译成 LiteralValue"""
+    number = _to_number(text)
+    return LiteralValue(text, number, text if number.__class__ is int else _format_like(number, "0"))
+
+
+def compile_value(chapter, value):
+    """把配置中的新值编译为 LiteralValue 或 ValueExpr，有误时抛出 ValueError"""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"新值 {value!r} 不是数字或计算式")
+    text = value if isinstance(value, str) else str(value)
+    if NUMERIC_VALUE_RE.fullmatch(text):
+        return literal_value(text)
+    if not isinstance(value, str):
+        raise ValueError(f"新值 {value!r} 不是数字")
+    return compile_expr(chapter, text)
+
+
+def value_source(value):
+    """新值在配置中的写法（字面值或计算式原文）"""
+    return value.source
+
+
+def _to_number(token):
+    return float(token) if "." in token else int(token)
+
+
+def _format_like(number, token):
+    """按原数字 token 的格式（整数或小数位数）输出计算结果"""
+    if "." in token:
+        decimals = len(token) - token.index(".") - 1
+        return f"{number:.{decimals}f}" + ("." if decimals == 0 else "")
+    if isinstance(number, float):
+        # 四舍五入（远离零），而不是 round() 的银行家舍入
+        number = int(number + 0.5) if number >= 0 else -int(-number + 0.5)
+    return str(number)
+
+
+def eval_expr(expr, token, refs=None):
+    """计算新数字的文本；token 为目标行原有的数字，refs 为 {行号: 该行修改前的数字或 None}
+    
+    需要的数字缺失时返回 None（不修改该行）。起始值引用其他行时，结果仍按目标行原有数字的格式输出。
+    """
+    start = token
+    if expr.base is not None:
+        start = refs.get(expr.base) if refs else None
+        if start is None:
+            return None
+    elif not expr.ops:
+        return token
+    
+    number = _to_number(start)
+    for op, (kind, operand) in expr.ops:
+        if kind == "ref":
+            operand = refs.get(operand) if refs else None
+            if operand is None:
+                return None
+            operand = _to_number(operand)
+        if op == "add":
+            number += operand
+        elif op == "mul":
+            number *= operand
+        elif op == "min":
+            number = max(number, operand)
+        else:
+            number = min(number, operand)
+    return _format_like(number, token)
+
+
+def format_value(value, token, refs=None):
+    """按目标行原有的数字 token 算出新数字的文本，None 表示不修改
+    
+    字面值写入整数 token 时直接用预先算好的文本，写入小数 token 时保留同样的小数位数。
+    """
+    if value.__class__ is LiteralValue:
+        return value.text if "." not in token else _format_like(value.number, token)
+    return eval_expr(value, token, refs)
+
+
+def apply_value(value, line, refs=None):
+    """对一行应用新值（LiteralValue 或 ValueExpr）：只替换行内第一个数字，行内没有数字时原样返回"""
+    match = NUMBER_RE.search(line)
+    if match is None:
+        return line
+    new_token = format_value(value, match.group(), refs)
+    if new_token is None:
+        return line
+    return line[:match.start()] + new_token + line[match.end():]
+
+
+def apply_value_bytes(value, line):
+    """apply_value 的字节版本（流式/原地/向量化修改使用，这几种模式不支持引用其他行）"""
+    match = NUMBER_BYTES_RE.search(line)
+    if match is None:
+        return line
+    new_token = format_value(value, match.group().decode('ascii'))
+    if new_token is None:
+        return line
+    return line[:match.start()] + new_token.encode('ascii') + line[match.end():]
+
+
+def _ref_tokens(lines, refs, matcher):
+    """{引用的行号: 该行的第一个数字}，行不存在或没有数字时为 None"""
+    tokens = {}
+    for line_number in refs:
+        match = matcher.search(lines[line_number - 1]) if line_number <= len(lines) else None
+        tokens[line_number] = match.group() if match else None
+    return tokens
+
+
+# 单个章节编译后的修改计划（不可变，同章节的所有存档共用）
+#   lines:   按行号排序的行号数组
+#   values:  与 lines 一一对应的新值：字面值为 LiteralValue，计算式为 ValueExpr
+#   matcher: 预编译的数字匹配正则
+#   digest:  修改内容的摘要，记录在存档目录索引里，用来判断存档是否已按本计划修改过
+#   refs:    计算式引用的其他行的行号（排序去重），没有引用时为空
+#   layout:  开启布局识别时为行号所依据的布局名（见 plan_for_save），否则为 None
+PatchPlan = namedtuple("PatchPlan", ["chapter", "lines", "values", "matcher", "digest", "refs", "layout"],
+                       defaults=((), None))
+
+# 配置文件内容哈希 -> (各章节 PatchPlan, settings)，同一份配置只编译一次
+_PLAN_CACHE = {}
+
+
+class ConfigError(ValueError):
+    """配置内容有误；errors 为发现的全部错误（而不是只有第一处）"""
+    
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__("配置有误:\n" + "\n".join(f"  {error}" for error in self.errors))
+
+
+def _check_modifications(chapter, modifications):
+    """校验章节修改表，返回 ([(行号, 新值), ...], [错误信息, ...])
+    
+    键必须是行号或布局中的字段名，值必须是数字（或数字字符串）或计算式，
+    行号必须在 1 到该章节布局的 max_line 之间（没有已知布局的章节不检查上限）。
+    """
+    if not isinstance(modifications, dict):
+        return [], [f"{chapter}: 应为 {{行号: 新值}} 对象，实际是 {type(modifications).__name__}"]
+    
+    layout = CHAPTER_LAYOUTS.get(chapter)
+    items = []
+    errors = []
+    for key, new_value in modifications.items():
+        try:
+            line_number = resolve_line(chapter, key)
+        except ValueError as e:
+            errors.append(f"{chapter}.{key}: {e}")
+            continue
+        
+        if line_number < 1 or (layout is not None and line_number > layout.max_line):
+            limit = f"1-{layout.max_line}" if layout is not None else "至少为 1"
+            errors.append(f"{chapter}.{key}: 行号 {line_number} 超出范围（{limit}）")
+            continue
+        
+        try:
+            value = value_source(compile_value(chapter, new_value))
+        except ValueError as e:
+            errors.append(f"{chapter}.{key}: {e}")
+            continue
+        items.append((line_number, value))
+    return items, errors
+
+
+def _plan_from_items(chapter, items, digest=None, layout=None):
+    """items 为 [(行号, 新值写法), ...]；digest 为已知的摘要（来自编译缓存）时不再计算
+    
+    layout 为行号所依据的布局名，开启布局识别时传入。
+    """
+    # 稳定排序：同一行号的多条修改仍按配置中的先后顺序生效
+    items = sorted(items, key=lambda item: item[0])
+    if digest is None:
+        # 不识别布局的计划摘要与之前的版本一致，已有的目录索引仍然有效
+        summary = items if layout is None else [layout, items]
+        digest = hashlib.sha256(json.dumps(summary).encode('utf-8')).hexdigest()
+    values = tuple(compile_value(chapter, new_value) for _, new_value in items)
+    refs = set()
+    for value in values:
+        if value.__class__ is ValueExpr:
+            if value.base is not None:
+                refs.add(value.base)
+            refs.update(operand for _, (kind, operand) in value.ops if kind == "ref")
+    return PatchPlan(
+        chapter,
+        array('l', [line_number for line_number, _ in items]),
+        values,
+        NUMBER_RE,
+        digest,
+        tuple(sorted(refs)),
+        layout,
+    )
+
+
+def compile_plan(chapter, modifications):
+    """校验章节修改表并编译成 PatchPlan；字段名在这里按章节布局一次性解析成行号，有误时抛出 ConfigError"""
+    items, errors = _check_modifications(chapter, modifications)
+    if errors:
+        raise ConfigError(errors)
+    return _plan_from_items(chapter, items)
+
+
+# (计划摘要, 章节, 目标布局名) -> 换算后的 PatchPlan
+_REMAP_CACHE = {}
+
+
+def _remap_expr(expr, source, target):
+    base = expr.base
+    if base is not None:
+        base = remap_line(base, source, target)
+        if base is None:
+            raise ValueError(f"计算式 {expr.source!r} 引用的行在 {target.name} 布局中没有对应的行")
+    ops = []
+    for op, (kind, operand) in expr.ops:
+        if kind == "ref":
+            operand = remap_line(operand, source, target)
+            if operand is None:
+                raise ValueError(f"计算式 {expr.source!r} 引用的行在 {target.name} 布局中没有对应的行")
+        ops.append((op, (kind, operand)))
+    return ValueExpr(expr.source, base, tuple(ops))
+
+
+def plan_for_save(plan, lines):
+    """开启布局识别时，按存档开头的行（fingerprint_layout）判断存档的实际布局，
+    与计划所依据的布局不同则返回换算了行号的计划，否则原样返回
+    
+    换算后的计划保留原摘要，目录索引照常按原计划判断是否已修改过。换算结果按目标布局缓存。
+    有修改的行在存档的布局中没有对应的行时抛出 ValueError（不猜测，避免改错行）。
+    """
+    if plan.layout is None:
+        return plan
+    source = LAYOUTS[plan.layout]
+    target = fingerprint_layout(lines, source)
+    if target is source:
+        return plan
+    
+    key = (plan.digest, plan.chapter, target.name)
+    remapped = _REMAP_CACHE.get(key)
+    if remapped is None:
+        items = []
+        for line_number, value in zip(plan.lines, plan.values):
+            mapped = remap_line(line_number, source, target)
+            if mapped is None:
+                raise ValueError(f"第 {line_number} 行（{source.name} 布局）在存档的 {target.name} 布局中没有对应的行")
+            if value.__class__ is ValueExpr:
+                value = _remap_expr(value, source, target)
+            items.append((mapped, value))
+        items.sort(key=lambda item: item[0])
+        refs = sorted({remap_line(line_number, source, target) for line_number in plan.refs})
+        remapped = _REMAP_CACHE[key] = plan._replace(
+            lines=array('l', [line_number for line_number, _ in items]),
+            values=tuple(value for _, value in items),
+            refs=tuple(refs),
+            layout=target.name,
+        )
+    return remapped
+
+
+def _read_head_lines(path, count=FINGERPRINT_LINES):
+    """读取文件开头 count 行（流式/原地修改前判断布局用）"""
+    lines = []
+    with open(path, 'rb') as f:
+        for line in f:
+            lines.append(line.decode('utf-8', errors='replace'))
+            if len(lines) >= count:
+                break
+    return lines
+
+
+def compile_config(raw):
+    """校验 drg.json 原始内容并编译成 {章节: PatchPlan} 和 settings，按内容哈希缓存
+    
+    所有章节都校验完后才报错，ConfigError 中包含全部错误。
+    settings.detect_layout 为 true 时，配置中的行号按各章节的默认布局理解，
+    每个存档处理前识别它的实际布局并换算行号（见 plan_for_save），同一份配置可以处理不同布局的存档。
+    """
+    digest = hashlib.sha256(raw).hexdigest()
+    cached = _PLAN_CACHE.get(digest)
+    
+    if cached is None:
+        try:
+            config = json.loads(raw.decode('utf-8'))
+        except ValueError as e:
+            raise ConfigError([f"不是有效的 JSON: {e}"]) from None
+        if not isinstance(config, dict):
+            raise ConfigError(["顶层应为 {章节: {行号: 新值}} 对象"])
+        
+        settings = config.pop("settings", {})
+        errors = []
+        if not isinstance(settings, dict):
+            errors.append("settings: 应为对象")
+            settings = {}
+        else:
+            if not isinstance(settings.get("save_path", ""), str):
+                errors.append("settings.save_path: 应为字符串")
+            if not isinstance(settings.get("detect_layout", False), bool):
+                errors.append("settings.detect_layout: 应为 true 或 false")
+        detect_layout = settings.get("detect_layout") is True
+        
+        plans = {}
+        for chapter, modifications in config.items():
+            items, chapter_errors = _check_modifications(chapter, modifications)
+            errors.extend(chapter_errors)
+            layout = CHAPTER_LAYOUTS.get(chapter) if detect_layout else None
+            plans[chapter] = _plan_from_items(chapter, items, layout=layout and layout.name)
+        if errors:
+            raise ConfigError(errors)
+        cached = _PLAN_CACHE[digest] = (plans, settings)
+    
+    plans, settings = cached
+    return dict(plans), dict(settings)
+
+
+# 配置编译缓存：保存在配置文件旁边的 .<配置文件名>.cache，内容为 JSON：
+#   {"version", "size", "mtime_ns", "sha256", "settings", "plans": {章节: {"lines", "values", "digest", "layout"}}}
+# values 保存新值的写法，读取缓存时计算式重新编译（不再校验）。
+# 编译规则变化时增加 CONFIG_CACHE_VERSION，旧缓存自动作废。
+CONFIG_CACHE_VERSION = 3
+
+
+def _config_cache_path(config_path):
+    directory, name = os.path.split(config_path)
+    return os.path.join(directory, f".{name}.cache")
+
+
+def _load_config_cache(cache_path):
+    """读取编译缓存，返回 (缓存内容, (plans, settings))；不存在、损坏或版本不符时返回 (None, None)"""
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = json.loads(f.read().decode('utf-8'))
+        if cached["version"] != CONFIG_CACHE_VERSION:
+            return None, None
+        plans = {
+            chapter: _plan_from_items(chapter, list(zip(plan["lines"], plan["values"])), plan["digest"],
+                                      plan["layout"])
+            for chapter, plan in cached["plans"].items()
+        }
+        return cached, (plans, dict(cached["settings"]))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None, None
+
+
+def compile_config_file(config_path):
+    """读取、校验并编译配置文件，编译结果缓存在配置文件旁边，返回 ({章节: PatchPlan}, settings)
+    
+    配置文件的大小和 mtime 都与缓存一致时不读取配置文件，直接使用缓存，跳过解析和校验；
+    mtime 变了但内容哈希相同（如被 touch 过）时同样使用缓存，只更新缓存中的 mtime。
+    缓存写不进去（如只读目录）时忽略，下次照常编译。
+    """
+    st = os.stat(config_path)
+    cache_path = _config_cache_path(config_path)
+    cached, result = _load_config_cache(cache_path)
+    
+    if cached is not None and cached.get("size") == st.st_size and cached.get("mtime_ns") == st.st_mtime_ns:
+        return result
+    
+    with open(config_path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    
+    if cached is None or cached.get("sha256") != digest:
+        result = compile_config(raw)
+        plans, settings = result
+        cached = {
+            "version": CONFIG_CACHE_VERSION,
+            "sha256": digest,
+            "settings": settings,
+            "plans": {
+                chapter: {"lines": list(plan.lines), "values": [value_source(value) for value in plan.values],
+                          "digest": plan.digest, "layout": plan.layout}
+                for chapter, plan in plans.items()
+            },
+        }
+    
+    cached["size"] = st.st_size
+    cached["mtime_ns"] = st.st_mtime_ns
+    try:
+        atomic_write(cache_path, json.dumps(cached, ensure_ascii=False).encode('utf-8'),
+                     mode_from=config_path)
+    except OSError:
+        pass
+    return result
+
+
+def apply_plan(content, plan, diff=None):
+    """一次拆分、一次遍历、一次合并，应用全部行修改（结果与逐条 modify_line 完全一致）
+    
+    传入 diff 列表时，顺便把每行的 (行号, 原值, 新值) 追加进去；行内没有数字时原值和新值都是 None。
+    开启了布局识别的计划先按存档的实际布局换算行号（见 plan_for_save）。
+    返回 (修改后内容, [(超出范围的行号, 总行数), ...])
+    """
+    lines = content.split('\n')
+    total = len(lines)
+    plan = plan_for_save(plan, lines)
+    out_of_range = []
+    # 计算式引用的是其他行修改前的数字，先全部取出
+    refs = _ref_tokens(lines, plan.refs, plan.matcher) if plan.refs else None
+    
+    for line_number, new_value in zip(plan.lines, plan.values):
+        target_index = line_number - 1
+        if target_index < 0 or target_index >= total:
+            out_of_range.append((line_number, total))
+            continue
+        
+        original_line = lines[target_index]
+        lines[target_index] = apply_value(new_value, original_line, refs)
+        
+        if diff is not None:
+            match = plan.matcher.search(original_line)
+            if match is None:
+                diff.append((line_number, None, None))
+            else:
+                # 替换后的数字位于原匹配起点到原行尾部之前
+                tail = len(original_line) - match.end()
+                new_token = lines[target_index][match.start():len(lines[target_index]) - tail]
+                diff.append((line_number, match.group(), new_token))
+    
+    return '\n'.join(lines), out_of_range
+
+
+# 单个存档的处理结果（patch_file 返回，批量模式下由子进程传回主进程）
+#   status: "patched" 已修改 / "unchanged" 已是目标值，未写入 / "skipped" 索引命中，未读取
+#           "dry-run" 仅预览 / "error" 出错
+#   diff:   预览模式下每行的 (行号, 原值, 新值)
+#   index_entry: 要写回存档目录索引的记录（见 load_patch_index）
+FileResult = namedtuple("FileResult", [
+    "save_path", "file", "chapter", "status", "backup", "out_of_range", "error", "diff",
+    "index_entry",
+], defaults=(None, None))
+
+# 存档目录索引文件名：记录每个存档上次处理后的大小、mtime、内容哈希和修改计划
+INDEX_FILENAME = ".drg_index.json"
+
+
+def load_patch_index(save_path):
+    """读取存档目录索引 {文件名: {"size", "mtime_ns", "sha256", "plan"}}，不存在或损坏时返回空表"""
+    try:
+        with open(os.path.join(save_path, INDEX_FILENAME), 'rb') as f:
+            index = json.loads(f.read().decode('utf-8'))
+        return dict(index.get("files", {}))
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def save_patch_index(save_path, index):
+    """写回存档目录索引"""
+    data = json.dumps({"version": 1, "files": index}, ensure_ascii=False, sort_keys=True)
+    atomic_write(os.path.join(save_path, INDEX_FILENAME), data.encode('utf-8'))
+
+
+def _index_entry(st, digest, plan):
+    """由 stat 结果和文件内容的 sha256 生成一条索引记录"""
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": digest,
+        "plan": plan.digest,
+    }
+
+
+def _index_fresh(known, st, plan):
+    """索引记录与当前 stat 和修改计划都一致时，说明存档自上次修改后没有变过"""
+    return (known.get("size") == st.st_size and known.get("mtime_ns") == st.st_mtime_ns
+            and known.get("plan") == plan.digest)
+
+
+def _skipped_result(file_path, plan, save_path, known):
+    """索引命中、未读取存档时的结果"""
+    return FileResult(save_path, file_path, plan.chapter, "skipped", None, (), None, None, known)
+
+
+def _unchanged_result(file_path, plan, save_path, out_of_range, st, digest):
+    """修改结果与原内容相同、未写入时的结果；st/digest 为原文件的 stat 和 sha256"""
+    return FileResult(save_path, file_path, plan.chapter, "unchanged",
+                      None, tuple(out_of_range), None, None, _index_entry(st, digest, plan))
+
+
+def _patched_result(file_path, plan, save_path, record, out_of_range, st, data):
+    """已备份并写入时的结果；st/data 为写入后的 stat 和内容"""
+    return FileResult(save_path, file_path, plan.chapter, "patched",
+                      record, tuple(out_of_range), None, None,
+                      _index_entry(st, hashlib.sha256(data).hexdigest(), plan))
+
+
+def _decide_patch(file_path, plan, save_path, raw, st, dry_run=False):
+    """内存模式的判断步骤，不做任何 I/O（patch_file 与异步流水线共用）
+    
+    raw/st 为已读入的存档内容和读取时的 stat。返回 (FileResult, 修改后内容, 超出范围列表)：
+    预览或已是目标值时 FileResult 就是最终结果；需要写入时 FileResult 为 None，
+    由调用方先备份、再写入修改后内容，最后用 _patched_result 生成结果。
+    """
+    # 按字节读写，不做换行转换，原有的 \r\n 原样保留在行尾
+    if dry_run:
+        diff = []
+        _, out_of_range = apply_plan(raw.decode('utf-8'), plan, diff)
+        return (FileResult(save_path, file_path, plan.chapter, "dry-run",
+                           None, tuple(out_of_range), None, tuple(diff)), None, out_of_range)
+    
+    modified_content, out_of_range = apply_plan(raw.decode('utf-8'), plan)
+    modified = modified_content.encode('utf-8')
+    if modified == raw:
+        return (_unchanged_result(file_path, plan, save_path, out_of_range, st,
+                                  hashlib.sha256(raw).hexdigest()), None, out_of_range)
+    return None, modified, out_of_range
+
+
+def patch_file(file_path, plan, save_path, dry_run=False, known=None, stream=False, inplace=False):
+    """处理单个存档文件但不输出任何内容，返回 FileResult
+    
+    dry_run 为 True 时只在内存中计算修改结果和逐行差异，既不写存档也不写备份。
+    known 是该存档在目录索引中的记录：大小、mtime 和修改计划都没变时只 stat 一次就跳过。
+    stream 为 True 时逐行流式处理，内存占用与存档大小无关（见 _stream_patch）。
+    inplace 为 True 时先尝试 mmap 原地改写（见 _patch_file_inplace），不满足条件再整文件重写。
+    计算式引用了其他行（plan.refs）时 stream/inplace 不起作用，改为整文件读入内存处理。
+    修改结果与原内容相同时不写备份也不写存档。
+    """
+    full_path = os.path.join(save_path, file_path)
+    
+    if known is not None and not dry_run and _index_fresh(known, os.stat(full_path), plan):
+        return _skipped_result(file_path, plan, save_path, known)
+    
+    if inplace and not dry_run and not plan.refs:
+        result = _patch_file_inplace(file_path, plan, save_path)
+        if result is not None:
+            return result
+    
+    if stream and not dry_run and not plan.refs:
+        return _patch_file_streaming(file_path, plan, save_path)
+    
+    # 每个存档只读一次：同一份字节既用于备份也用于修改
+    raw, st = _read_bytes(full_path)
+    result, modified, out_of_range = _decide_patch(file_path, plan, save_path, raw, st, dry_run)
+    if result is not None:
+        return result
+    
+    record = _write_backup(full_path, raw)
+    atomic_write(full_path, modified)
+    return _patched_result(file_path, plan, save_path, record, out_of_range, os.stat(full_path), modified)
+
+
+# 流式修改时，最后一个目标行之后的内容按块整体复制，每块的大小
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def _stream_patch(full_path, plan):
+    """流式修改：逐行读取存档，只改目标行，边读边写到同目录的临时文件；
+    最后一个目标行之后不再逐行处理，剩余内容按块整体复制。
+    
+    同一遍读取同时写出备份临时文件、计算原内容和新内容的 sha256，
+    内存占用只和最长的一行有关，与存档大小无关。行号规则与 apply_plan 完全一致。
+    返回 (是否有改动, 超出范围列表, 输出临时文件, 备份临时文件, 原内容 sha256, 新内容 sha256, 原文件 stat)
+    """
+    objects_dir = os.path.join(os.path.dirname(full_path), BACKUP_DIRNAME, "objects")
+    os.makedirs(objects_dir, exist_ok=True)
+    out_temp = _temp_path_for(full_path)
+    backup_temp = _temp_path_for(os.path.join(objects_dir, "stream"), mode_from=full_path)
+    
+    targets = list(zip(plan.lines, plan.values))
+    count = len(targets)
+    raw_hash = hashlib.sha256()
+    new_hash = hashlib.sha256()
+    changed = False
+    
+    # 行号小于 1 的修改一定超出范围，先跳过，否则会一直等不到对应的行
+    pending = 0
+    while pending < count and targets[pending][0] < 1:
+        pending += 1
+    below = targets[:pending]
+    
+    try:
+        with open(full_path, 'rb') as src, open(out_temp, 'wb') as out, open(backup_temp, 'wb') as bak:
+            st = os.fstat(src.fileno())
+            line_number = 0
+            newlines = 0
+            
+            while pending < count:
+                line = src.readline()
+                if not line:
+                    break
+                raw_hash.update(line)
+                bak.write(line)
+                line_number += 1
+                if line.endswith(b'\n'):
+                    newlines += 1
+                
+                original_line = line
+                while pending < count and targets[pending][0] == line_number:
+                    line = apply_value_bytes(targets[pending][1], line)
+                    pending += 1
+                if line != original_line:
+                    changed = True
+                
+                out.write(line)
+                new_hash.update(line)
+            
+            while True:
+                chunk = src.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                newlines += chunk.count(b'\n')
+                raw_hash.update(chunk)
+                bak.write(chunk)
+                out.write(chunk)
+                new_hash.update(chunk)
+    except BaseException:
+        os.remove(out_temp)
+        os.remove(backup_temp)
+        raise
+    
+    # 与 content.split('\n') 的行数一致：换行符个数 + 1
+    total = newlines + 1
+    out_of_range = [(target, total) for target, _ in below]
+    out_of_range.extend((target, total) for target, _ in targets[pending:] if target > total)
+    
+    return (changed, out_of_range, out_temp, backup_temp,
+            raw_hash.hexdigest(), new_hash.hexdigest(), st)
+
+
+def _patch_file_streaming(file_path, plan, save_path):
+    """patch_file 的流式版本：用 _stream_patch 的两个临时文件完成备份和写入"""
+    full_path = os.path.join(save_path, file_path)
+    if plan.layout is not None:
+        plan = plan_for_save(plan, _read_head_lines(full_path))
+    changed, out_of_range, out_temp, backup_temp, raw_digest, new_digest, st = \
+        _stream_patch(full_path, plan)
+    
+    if not changed:
+        os.remove(out_temp)
+        os.remove(backup_temp)
+        return _unchanged_result(file_path, plan, save_path, out_of_range, st, raw_digest)
+    
+    object_path = _backup_object_path(save_path, raw_digest)
+    if os.path.exists(object_path):
+        os.remove(backup_temp)
+    else:
+        _replace_synced(backup_temp, object_path)
+    record = _backup_record(file_path, raw_digest, st.st_size)
+    journal_backup(save_path, record)
+    
+    _replace_synced(out_temp, full_path)
+    
+    return FileResult(save_path, file_path, plan.chapter, "patched",
+                      record, tuple(out_of_range), None, None,
+                      _index_entry(os.stat(full_path), new_digest, plan))
+
+
+def _locate_inplace_edits(mm, plan):
+    """在映射的存档中找出每个目标行的字节偏移并算出替换后的内容
+    
+    返回 ([(偏移, 新内容), ...], 超出范围列表)；只包含内容真正变化的行。
+    任何一行替换前后字节数不同都返回 (None, None)，表示不能原地修改。
+    """
+    size = len(mm)
+    line_number = 1
+    start = 0
+    lines = {}  # 行起始偏移 -> (原内容, 当前内容)，同一行的多条修改依次叠加
+    out_of_range = []
+    
+    for target, value in zip(plan.lines, plan.values):
+        if target < 1:
+            out_of_range.append(target)
+            continue
+        
+        while line_number < target:
+            newline = mm.find(b'\n', start)
+            if newline < 0:
+                break
+            start = newline + 1
+            line_number += 1
+        if line_number < target:
+            out_of_range.append(target)
+            continue
+        
+        if start not in lines:
+            end = mm.find(b'\n', start)
+            original = mm[start:size if end < 0 else end]
+            lines[start] = (original, original)
+        original, current = lines[start]
+        
+        replaced = apply_value_bytes(value, current)
+        if len(replaced) != len(current):
+            return None, None
+        lines[start] = (original, replaced)
+    
+    if out_of_range:
+        # 与 content.split('\n') 的行数一致：换行符个数 + 1
+        while True:
+            newline = mm.find(b'\n', start)
+            if newline < 0:
+                break
+            start = newline + 1
+            line_number += 1
+        out_of_range = [(target, line_number) for target in out_of_range]
+    
+    edits = [(offset, current) for offset, (original, current) in lines.items() if current != original]
+    return edits, out_of_range
+
+
+def _patch_file_inplace(file_path, plan, save_path):
+    """mmap 原地修改：所有替换都等宽（如 9999 换成 9999、四位数换成四位数）时，
+    只改写目标行的字节，不重写整个文件，写放大接近零。
+    
+    备份照常先写入备份仓库。原地改写不是 os.replace 那种原子替换，
+    但只覆盖少量等长字节，中途出错时仍可从备份恢复。
+    存档为空或任何一处宽度不同时返回 None，由调用方改走整文件重写。
+    """
+    import mmap
+    
+    full_path = os.path.join(save_path, file_path)
+    if plan.layout is not None:
+        plan = plan_for_save(plan, _read_head_lines(full_path))
+    
+    with open(full_path, 'r+b') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return None
+        
+        with mmap.mmap(f.fileno(), 0) as mm:
+            edits, out_of_range = _locate_inplace_edits(mm, plan)
+            if edits is None:
+                return None
+            if not edits:
+                return _unchanged_result(file_path, plan, save_path, out_of_range, st,
+                                         hashlib.sha256(mm).hexdigest())
+            
+            record = _write_backup(full_path, mm)
+            for offset, data in edits:
+                mm[offset:offset + len(data)] = data
+            mm.flush()
+            digest = hashlib.sha256(mm).hexdigest()
+        
+        os.fsync(f.fileno())
+    
+    return FileResult(save_path, file_path, plan.chapter, "patched",
+                      record, tuple(out_of_range), None, None,
+                      _index_entry(os.stat(full_path), digest, plan))
+
+
+# 向量化引擎每批处理的存档数：同一批存档读入同一块缓冲区，批越大越省调用开销，也越占内存
+VECTOR_CHUNK_FILES = 128
 
 
-def load_config(filename="drg.json"):
-    """从 exe 所在目录加载配置，找不到则提示选择或恢复备份"""
-    config_path = os.path.join(EXE_DIR, filename)
+@lru_cache(maxsize=None)
+def _numpy():
+    """NumPy 是可选依赖：已安装时用它查找换行符，没有时返回 None，改用纯 Python 实现"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _locate_lines(buffer, spans, targets):
+    """在多个存档拼接成的缓冲区中找出每个存档每个目标行的字节范围
     
-    if not os.path.exists(config_path):
-        print(f"\n未找到默认配置文件: {config_path}")
-        print("按 1 选择配置文件，按 3 恢复备份，或其他键退出...")
+    spans 为每个存档在缓冲区中的 (起点, 终点)，targets 为行号列表（从 1 开始）。
+    返回 (starts, ends, totals)：starts[i][j]/ends[i][j] 是第 i 个存档第 targets[j] 行
+    （不含换行符）的起止偏移，该行不存在时起点为 -1；totals[i] 是第 i 个存档的行数，
+    与 content.split('\\n') 一致（换行符个数 + 1）。
+    """
+    np = _numpy()
+    if np is None:
+        return _locate_lines_python(buffer, spans, targets)
+    
+    # 一次比较找出整块缓冲区中所有换行符；末尾补一个哨兵，越界的下标统一落到它上面
+    newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == 10)
+    sentinel = np.append(newlines, len(buffer))
+    bounds = np.array(spans, dtype=np.int64).reshape(-1, 2)
+    file_starts = bounds[:, :1]
+    file_ends = bounds[:, 1:]
+    # 每个存档的第一个换行符在 newlines 中的下标，以及换行符个数
+    first = np.searchsorted(newlines, file_starts)
+    counts = np.searchsorted(newlines, file_ends) - first
+    
+    lines = np.array(targets, dtype=np.int64).reshape(1, -1)
+    limit = len(sentinel) - 1
+    # 第 L 行从第 L-1 个换行符之后开始（第 1 行从存档起点开始），到第 L 个换行符结束（最后一行到存档终点）
+    starts = np.where(lines == 1, file_starts, sentinel[np.clip(first + lines - 2, 0, limit)] + 1)
+    ends = np.where(lines <= counts, sentinel[np.clip(first + lines - 1, 0, limit)], file_ends)
+    starts = np.where((lines >= 1) & (lines <= counts + 1), starts, -1)
+    return starts.tolist(), ends.tolist(), (counts[:, 0] + 1).tolist()
+
+
+def _locate_lines_python(buffer, spans, targets):
+    """_locate_lines 的纯 Python 实现：逐个存档用 bytes.find 走到最后一个目标行"""
+    order = sorted(range(len(targets)), key=targets.__getitem__)
+    all_starts, all_ends, totals = [], [], []
+    
+    for file_start, file_end in spans:
+        total = buffer.count(b'\n', file_start, file_end) + 1
+        starts = [-1] * len(targets)
+        ends = [-1] * len(targets)
+        line_number = 1
+        position = file_start
+        for j in order:
+            target = targets[j]
+            if target < 1 or target > total:
+                continue
+            while line_number < target:
+                position = buffer.find(b'\n', position, file_end) + 1
+                line_number += 1
+            newline = buffer.find(b'\n', position, file_end)
+            starts[j] = position
+            ends[j] = file_end if newline < 0 else newline
+        all_starts.append(starts)
+        all_ends.append(ends)
+        totals.append(total)
+    
+    return all_starts, all_ends, totals
+
+
+def _vector_modify(buffer, spans, plan):
+    """对缓冲区中的每个存档应用同一个修改计划（结果与 apply_plan 逐字节一致）
+    
+    返回 [(修改后内容, 超出范围列表), ...]，与 spans 一一对应；没有任何变化的存档修改后内容为 None。
+    计划中不能有行引用（plan.refs）或布局识别（plan.layout），这两种由调用方逐个存档处理。
+    """
+    all_starts, all_ends, totals = _locate_lines(buffer, spans, plan.lines)
+    results = []
+    
+    for (file_start, file_end), starts, ends, total in zip(spans, all_starts, all_ends, totals):
+        out_of_range = []
+        lines = {}  # 行起始偏移 -> [行终点, 原内容, 当前内容]，同一行的多条修改依次叠加
+        for line_number, value, start, end in zip(plan.lines, plan.values, starts, ends):
+            if start < 0:
+                out_of_range.append((line_number, total))
+                continue
+            if start not in lines:
+                original = buffer[start:end]
+                lines[start] = [end, original, original]
+            line = lines[start]
+            line[2] = apply_value_bytes(value, line[2])
         
+        pieces = []
+        position = file_start
+        for start in sorted(lines):
+            end, original, current = lines[start]
+            if current != original:
+                pieces.append(buffer[position:start])
+                pieces.append(current)
+                position = end
+        if pieces:
+            pieces.append(buffer[position:file_end])
+            results.append((b"".join(pieces), out_of_range))
+        else:
+            results.append((None, out_of_range))
+    
+    return results
+
+
+def vector_patch(tasks):
+    """向量化引擎：一次处理一批使用同一修改计划的存档（同一章节的各个存档位），返回 FileResult 列表
+    
+    tasks 的格式同 _batch_worker。索引命中的存档直接跳过，其余存档读入同一块缓冲区，
+    一次找出全部目标行的偏移（见 _locate_lines）后批量替换，再拆回各个存档，
+    备份、原子写入和索引记录与 patch_file 完全相同。
+    计划带行引用或布局识别时逐个存档交给 patch_file。
+    """
+    plan = tasks[0][1]
+    if plan.refs or plan.layout is not None:
+        return [_batch_worker(task) for task in tasks]
+    
+    results = [None] * len(tasks)
+    loaded = []  # (任务下标, 完整路径, 原内容, stat)
+    for i, (file_path, _, save_path, known, _) in enumerate(tasks):
+        full_path = os.path.join(save_path, file_path)
         try:
-            choice = input("> ").strip()
-        except:
-            choice = ""
-        
-        if choice == "1":
-            selected = select_file_dialog()
-            if selected and os.path.exists(selected):
-                config_path = selected
-                print(f"已选择: {config_path}")
+            if known is not None and _index_fresh(known, os.stat(full_path), plan):
+                results[i] = _skipped_result(file_path, plan, save_path, known)
+                continue
+            raw, st = _read_bytes(full_path)
+        except Exception as e:
+            results[i] = FileResult(save_path, file_path, plan.chapter, "error", None, (), str(e))
+            continue
+        loaded.append((i, full_path, raw, st))
+    
+    spans = []
+    position = 0
+    for _, _, raw, _ in loaded:
+        spans.append((position, position + len(raw)))
+        position += len(raw)
+    modified = _vector_modify(b"".join(raw for _, _, raw, _ in loaded), spans, plan) if loaded else []
+    
+    for (i, full_path, raw, st), (data, out_of_range) in zip(loaded, modified):
+        file_path, _, save_path, _, _ = tasks[i]
+        try:
+            if data is None or data == raw:
+                results[i] = _unchanged_result(file_path, plan, save_path, out_of_range, st,
+                                               hashlib.sha256(raw).hexdigest())
+                continue
+            
+            record = _write_backup(full_path, raw)
+            atomic_write(full_path, data)
+            results[i] = _patched_result(file_path, plan, save_path, record, out_of_range,
+                                         os.stat(full_path), data)
+        except Exception as e:
+            results[i] = FileResult(save_path, file_path, plan.chapter, "error", None, (), str(e))
+    
+    return results
+
+
+def describe_result(result, plan):
+    """单个存档处理结果的控制台说明（不含“处理: 文件名”标题行），返回文本行列表"""
+    if result.status == "skipped":
+        return ["  索引显示已修改过，跳过"]
+    if result.status == "unchanged":
+        return ["  已是目标值，无需备份和写入"]
+    if result.status == "error":
+        return [f"  错误: {result.error}"]
+    
+    lines = []
+    if result.status == "patched":
+        lines.append(f"  已备份: {result.file} ({result.backup['sha256'][:12]})")
+    for line_number, total in result.out_of_range:
+        lines.append(f"  警告: 行号 {line_number} 超出范围 (共 {total} 行)")
+    
+    if result.status == "dry-run":
+        for line_number, old_value, new_value in result.diff:
+            lines.append(f"  第 {line_number} 行: {old_value} -> {new_value}")
+        lines.append(f"  预览完成（未写入）")
+        return lines
+    
+    for line_number, new_value in zip(plan.lines, plan.values):
+        lines.append(f"  第 {line_number} 行 -> {value_source(new_value)}")
+    lines.append(f"  完成")
+    return lines
+
+
+def process_file(file_path, plan, save_path, dry_run=False, index=None):
+    """处理单个存档文件并输出过程（修改模式；dry_run 时只预览差异）
+    
+    index 为该目录的索引表（load_patch_index 的结果）；处理结果需交给 commit_save_dir 落盘。
+    不需要输出时使用 patch_file，整目录处理使用 Patcher。
+    """
+    print(f"\n处理: {file_path}")
+    known = index.get(file_path) if index is not None else None
+    result = patch_file(file_path, plan, save_path, dry_run, known)
+    
+    for line in describe_result(result, plan):
+        print(line)
+    return result
+
+
+def expand_save_roots(roots):
+    """展开存档目录列表（支持通配符），去重后只保留存在的目录"""
+    save_roots = []
+    seen = set()
+    
+    for root in roots:
+        for path in sorted(glob.glob(root)):
+            path = os.path.normpath(path)
+            if path not in seen and os.path.isdir(path):
+                seen.add(path)
+                save_roots.append(path)
+    
+    return save_roots
+
+
+def _batch_worker(task):
+    """进程池任务：处理单个存档，异常转成 error 结果返回而不是抛出"""
+    file_path, plan, save_path, known, options = task
+    try:
+        return patch_file(file_path, plan, save_path, known=known, **options)
+    except Exception as e:
+        return FileResult(save_path, file_path, plan.chapter, "error", None, (), str(e))
+
+
+def _batch_chunk_worker(tasks):
+    """进程池任务：逐个处理一批存档，返回 FileResult 列表"""
+    return [_batch_worker(task) for task in tasks]
+
+
+def _vector_batch_worker(tasks):
+    """进程池任务：用向量化引擎处理一批同一计划的存档，出错时整批改为逐个处理"""
+    try:
+        return vector_patch(tasks)
+    except Exception:
+        return _batch_chunk_worker(tasks)
+
+
+def _metered_batch_worker(worker, tasks):
+    """开启计时时的进程池任务：子进程同样开启计时，本次任务的统计随结果一起传回主进程"""
+    metrics = enable_metrics()
+    metrics.reset()
+    return worker(tasks), metrics.snapshot()
+
+
+def _vector_chunks(tasks):
+    """把任务按修改计划分组（同一目录同一章节的任务是连续的），每组最多 VECTOR_CHUNK_FILES 个"""
+    chunk = []
+    for task in tasks:
+        if chunk and (task[1] is not chunk[0][1] or len(chunk) >= VECTOR_CHUNK_FILES):
+            yield chunk
+            chunk = []
+        chunk.append(task)
+    if chunk:
+        yield chunk
+
+
+def run_batch(config, roots, workers=None, dry_run=False, stream=False, inplace=False, progress=None,
+              vectorize=False):
+    """批量模式：用进程池处理多个存档目录下的所有章节存档，返回 Results
+    
+    workers 为 None 时使用 CPU 核数，为 1 时在当前进程内顺序处理。
+    dry_run 为 True 时只预览，不写任何文件；stream/inplace 含义同 patch_file。
+    vectorize 为 True 时同一章节的存档成批交给向量化引擎（见 vector_patch），
+    此时 stream/inplace 不起作用；dry_run 时仍逐个存档预览。
+    progress 为可选回调，每个存档处理完后按发现顺序调用 progress(FileResult)。
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    
+    options = {"dry_run": dry_run, "stream": stream, "inplace": inplace}
+    save_roots = expand_save_roots(roots)
+    indexes = {}
+    tasks = []
+    for save_path in save_roots:
+        index = indexes[save_path] = {} if dry_run else load_patch_index(save_path)
+        dir_index = scan_save_dir(save_path, config)
+        for chapter_key, plan in config.items():
+            tasks.extend((save_file, plan, save_path, index.get(save_file), options)
+                         for save_file in dir_index.saves[chapter_key])
+    
+    if vectorize and not dry_run:
+        worker = _vector_batch_worker
+        chunks = list(_vector_chunks(tasks))
+    else:
+        worker = _batch_chunk_worker
+        chunks = [[task] for task in tasks]
+    
+    workers = workers or os.cpu_count() or 1
+    if os.name == 'nt':
+        # Windows 下进程池最多 61 个工作进程
+        workers = min(workers, 61)
+    
+    results = []
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            for result in worker(chunk):
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    else:
+        chunksize = max(1, len(chunks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            if METRICS is None:
+                outcomes = ((chunk_results, None) for chunk_results in
+                            executor.map(worker, chunks, chunksize=chunksize))
             else:
-                raise FileNotFoundError("未选择有效文件")
-        elif choice == "3":
-            return None, None, True  # 第三个值标记进入恢复模式
-        else:
-            raise FileNotFoundError("用户取消选择")
+                outcomes = executor.map(partial(_metered_batch_worker, worker), chunks, chunksize=chunksize)
+            for chunk_results, snapshot in outcomes:
+                if snapshot is not None:
+                    METRICS.merge(snapshot)
+                for result in chunk_results:
+                    results.append(result)
+                    if progress is not None:
+                        progress(result)
     
-    with open(config_path, 'r', encoding='utf-8') as f:
-        config = json.load(f)
+    if not dry_run:
+        # 子进程只返回索引和备份记录，由主进程按目录统一写回，避免多个进程同时改同一个文件
+        by_root = {save_path: [] for save_path in save_roots}
+        for result in results:
+            by_root[result.save_path].append(result)
+        for save_path in save_roots:
+            commit_save_dir(save_path, indexes[save_path], by_root[save_path])
     
-    settings = config.pop("settings", {})
-    save_path = settings.get("save_path", "./")
+    return _summarize(save_roots, results)
+
+
+# 一次批量处理的汇总（run_batch / run_pipeline / Patcher.apply 返回）
+#   roots:   实际处理的存档目录；results: 每个存档的 FileResult，按发现顺序排列
+#   patched / unchanged（含索引跳过）/ previewed / failed: 各状态的存档数
+Results = namedtuple("Results", ["roots", "results", "patched", "unchanged", "previewed", "failed"])
+
+
+def _summarize(save_roots, results):
+    """批量处理汇总（run_batch / run_pipeline 共用）"""
+    return Results(
+        save_roots,
+        results,
+        sum(1 for r in results if r.status == "patched"),
+        sum(1 for r in results if r.status in ("unchanged", "skipped")),
+        sum(1 for r in results if r.status == "dry-run"),
+        sum(1 for r in results if r.status == "error"),
+    )
+
+
+class LocalFS:
+    """异步流水线使用的文件系统操作（全部是阻塞调用，由流水线放到线程池里执行）"""
     
-    if not os.path.isabs(save_path):
-        save_path = os.path.join(EXE_DIR, save_path)
+    def scan(self, save_path, chapter_keys):
+        return scan_save_dir(save_path, chapter_keys)
     
-    save_path = os.path.normpath(save_path)
+    def load_index(self, save_path):
+        return load_patch_index(save_path)
     
-    return config, save_path, False
+    def stat(self, path):
+        return os.stat(path)
+    
+    def read(self, path):
+        return _read_bytes(path)
+    
+    def backup(self, full_path, data):
+        return _write_backup(full_path, data)
+    
+    def write(self, path, data):
+        atomic_write(path, data)
+        return os.stat(path)
+    
+    def commit(self, save_path, index, results):
+        commit_save_dir(save_path, index, results)
 
 
-def find_save_files(base_name, save_path):
-    """在指定目录查找存档文件"""
-    pattern = os.path.join(save_path, f"{base_name}_*")
-    files = glob.glob(pattern)
+class LatencyFS(LocalFS):
+    """给每次文件操作加上固定延迟，用来在本地模拟慢速/网络文件系统"""
+    
+    def __init__(self, latency=0.02):
+        self.latency = latency
+    
+    def scan(self, save_path, chapter_keys):
+        time.sleep(self.latency)
+        return super().scan(save_path, chapter_keys)
+    
+    def load_index(self, save_path):
+        time.sleep(self.latency)
+        return super().load_index(save_path)
     
-    valid_files = []
-    for f in files:
-        fname = os.path.basename(f)
-        if re.match(rf"^{base_name}_\d+$", fname):
-            valid_files.append(fname)
+    def stat(self, path):
+        time.sleep(self.latency)
+        return super().stat(path)
     
-    return valid_files, save_path
+    def read(self, path):
+        time.sleep(self.latency)
+        return super().read(path)
+    
+    def backup(self, full_path, data):
+        time.sleep(self.latency)
+        return super().backup(full_path, data)
+    
+    def write(self, path, data):
+        time.sleep(self.latency)
+        return super().write(path, data)
+    
+    def commit(self, save_path, index, results):
+        time.sleep(self.latency)
+        return super().commit(save_path, index, results)
 
 
-def find_backup_files(save_path):
-    """查找所有备份文件"""
-    pattern = os.path.join(save_path, "*.backup")
-    return glob.glob(pattern)
+def run_pipeline(config, roots, max_in_flight=32, io_workers=8, dry_run=False, fs=None, progress=None):
+    """异步流水线模式：发现 -> 读取 -> 备份 -> 修改 -> 写入，适合慢速或网络文件系统
+    
+    阻塞的文件操作放在 io_workers 个线程的线程池中执行，同时处理中的存档最多 max_in_flight 个，
+    发现阶段在队列满时暂停（背压）。修改（apply_plan）只在事件循环线程中执行，不会并发；
+    结果按发现顺序排列，与 run_batch 一致。fs 默认为 LocalFS，可换成 LatencyFS 做本地测试。
+    progress 为可选回调，按完成顺序（不一定是发现顺序）调用 progress(FileResult)。
+    """
+    import asyncio
+    
+    return asyncio.run(_pipeline(config, expand_save_roots(roots), max_in_flight,
+                                 io_workers, dry_run, fs or LocalFS(), progress))
 
 
-def backup_file(file_path, save_path):
-    """创建备份（覆盖旧备份）"""
-    full_path = os.path.join(save_path, file_path)
-    backup_path = f"{full_path}.backup"
+async def _pipeline(config, save_roots, max_in_flight, io_workers, dry_run, fs, progress=None):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_in_flight)
+    indexes = {}
+    results = []
     
-    with open(full_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    with open(backup_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        def io(func, *args):
+            return loop.run_in_executor(executor, func, *args)
+        
+        async def discover():
+            for save_path in save_roots:
+                dir_index = await io(fs.scan, save_path, tuple(config))
+                index = indexes[save_path] = {} if dry_run else await io(fs.load_index, save_path)
+                for chapter_key, plan in config.items():
+                    for save_file in dir_index.saves[chapter_key]:
+                        results.append(None)
+                        await queue.put((len(results) - 1, save_file, plan, save_path,
+                                         index.get(save_file)))
+            for _ in range(max_in_flight):
+                await queue.put(None)
+        
+        async def handle():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                seq, file_path, plan, save_path, known = item
+                try:
+                    results[seq] = await _pipeline_file(io, fs, file_path, plan, save_path,
+                                                        known, dry_run)
+                except Exception as e:
+                    results[seq] = FileResult(save_path, file_path, plan.chapter, "error",
+                                              None, (), str(e))
+                if progress is not None:
+                    progress(results[seq])
+        
+        await asyncio.gather(discover(), *(handle() for _ in range(max_in_flight)))
+        
+        if not dry_run:
+            by_root = {save_path: [] for save_path in save_roots}
+            for result in results:
+                by_root[result.save_path].append(result)
+            await asyncio.gather(*(io(fs.commit, save_path, indexes[save_path], by_root[save_path])
+                                   for save_path in save_roots))
     
-    print(f"  已备份: {os.path.basename(backup_path)}")
-    return backup_path
+    return _summarize(save_roots, results)
 
 
-def restore_backup(file_path, save_path):
-    """从备份恢复"""
+async def _pipeline_file(io, fs, file_path, plan, save_path, known, dry_run):
+    """流水线中单个存档的处理：判断步骤与 patch_file 的内存模式共用 _decide_patch，只有 I/O 经由 fs"""
     full_path = os.path.join(save_path, file_path)
-    backup_path = f"{full_path}.backup"
     
-    if not os.path.exists(backup_path):
-        print(f"  警告: 无备份文件 {os.path.basename(backup_path)}")
-        return False
+    if known is not None and not dry_run and _index_fresh(known, await io(fs.stat, full_path), plan):
+        return _skipped_result(file_path, plan, save_path, known)
     
-    # 恢复前保存当前状态到临时文件
-    if os.path.exists(full_path):
-        temp_backup = f"{full_path}.temp"
-        shutil.copy2(full_path, temp_backup)
+    raw, st = await io(fs.read, full_path)
+    result, modified, out_of_range = _decide_patch(file_path, plan, save_path, raw, st, dry_run)
+    if result is not None:
+        return result
     
-    # 执行恢复
-    shutil.copy2(backup_path, full_path)
+    record = await io(fs.backup, full_path, raw)
+    new_st = await io(fs.write, full_path, modified)
+    return _patched_result(file_path, plan, save_path, record, out_of_range, new_st, modified)
+
+
+def watch(config, roots, interval=1.0, settle=0.5, stream=False, inplace=False, progress=None, stop=None):
+    """监视模式：常驻运行，游戏写入存档后自动重新修改；返回修改过（含已是目标值）的存档数
     
-    # 删除临时备份
-    if os.path.exists(temp_backup):
-        os.remove(temp_backup)
+    编译好的配置和各目录的索引一直保存在内存中。每隔 interval 秒只 stat 一次各存档目录和已知的存档，
+    目录的 mtime 变了（新建或改名了文件）才重新扫描目录。
+    存档的大小或 mtime 与索引中的记录不同，并且连续 settle 秒不再变化后才处理，避免读到游戏写了一半的存档；
+    索引记录的是本程序写入后的状态，所以自己写入存档不会再次触发。
+    处理失败的存档在它再次变化之前不会重试。
+    progress 同 Patcher；stop 为可选的无参函数，返回 True 时退出，默认一直运行到 KeyboardInterrupt。
+    轮询在所有平台上都可用，不依赖 inotify 等系统接口。
+    """
+    chapter_keys = tuple(config)
+    # 存档目录 -> [目录 mtime_ns, {存档名: PatchPlan}, 目录索引]
+    dirs = {save_path: [None, {}, load_patch_index(save_path)] for save_path in expand_save_roots(roots)}
+    pending = {}  # (目录, 存档名) -> ((大小, mtime_ns), 第一次看到这个状态的时间)
+    failed = {}   # (目录, 存档名) -> 处理失败时的 (大小, mtime_ns)
+    handled = 0
     
-    print(f"  已恢复: {file_path}")
-    return True
+    while stop is None or not stop():
+        now = time.monotonic()
+        for save_path, state in dirs.items():
+            try:
+                dir_mtime = os.stat(save_path).st_mtime_ns
+            except OSError:
+                continue
+            if dir_mtime != state[0]:
+                state[0] = dir_mtime
+                dir_index = scan_save_dir(save_path, chapter_keys)
+                state[1] = {save_file: config[chapter_key]
+                            for chapter_key in chapter_keys for save_file in dir_index.saves[chapter_key]}
+            saves, index = state[1], state[2]
+            
+            for save_file, plan in saves.items():
+                key = (save_path, save_file)
+                try:
+                    st = os.stat(os.path.join(save_path, save_file))
+                except OSError:
+                    pending.pop(key, None)
+                    continue
+                
+                known = index.get(save_file)
+                observed = (st.st_size, st.st_mtime_ns)
+                if (known is not None and _index_fresh(known, st, plan)) or failed.get(key) == observed:
+                    pending.pop(key, None)
+                    continue
+                
+                seen = pending.get(key)
+                if seen is None or seen[0] != observed:
+                    pending[key] = (observed, now)
+                    continue
+                if now - seen[1] < settle:
+                    continue
+                del pending[key]
+                
+                try:
+                    result = patch_file(save_file, plan, save_path, stream=stream, inplace=inplace)
+                except Exception as e:
+                    result = FileResult(save_path, save_file, plan.chapter, "error", None, (), str(e))
+                    failed[key] = observed
+                else:
+                    failed.pop(key, None)
+                    handled += 1
+                commit_save_dir(save_path, index, [result])
+                # 写索引（临时文件 + os.replace）会改变目录的 mtime，记下新值，避免下一轮因为自己的写入重新扫描目录。
+                # 代价：提交期间恰好有其他程序新建的存档要等目录下次变化时才会被发现。
+                try:
+                    state[0] = os.stat(save_path).st_mtime_ns
+                except OSError:
+                    pass
+                if progress is not None:
+                    progress(result)
+        
+        time.sleep(interval)
+    
+    return handled
 
 
-def modify_line(content, line_number, new_value):
-    """修改指定行的数字"""
-    lines = content.split('\n')
-    target_index = line_number - 1
+def dry_run_report(summary):
+    """把预览模式的汇总转成可 JSON 序列化的报告"""
+    files = []
+    for result in summary.results:
+        files.append({
+            "path": os.path.join(result.save_path, result.file),
+            "chapter": result.chapter,
+            "status": result.status,
+            "error": result.error,
+            "changes": [
+                {"line": line_number, "old": old_value, "new": new_value}
+                for line_number, old_value, new_value in (result.diff or ())
+            ],
+            "out_of_range": [line_number for line_number, _ in result.out_of_range],
+        })
     
-    if target_index < 0 or target_index >= len(lines):
-        print(f"  警告: 行号 {line_number} 超出范围 (共 {len(lines)} 行)")
-        return content
+    return {
+        "dry_run": True,
+        "roots": summary.roots,
+        "files": files,
+        "previewed": summary.previewed,
+        "failed": summary.failed,
+    }
+
+
+def print_batch_summary(summary):
+    """输出批量模式汇总"""
+    print(f"\n{'='*50}")
+    print(f"批量处理: {len(summary.roots)} 个存档目录，{len(summary.results)} 个存档")
     
-    original_line = lines[target_index]
-    modified_line = re.sub(r'\d+\.?\d*', str(new_value), original_line, count=1)
-    lines[target_index] = modified_line
+    for result in summary.results:
+        if result.status == "error":
+            print(f"  错误: {os.path.join(result.save_path, result.file)}: {result.error}")
+        elif result.out_of_range:
+            lines = ", ".join(str(line_number) for line_number, _ in result.out_of_range)
+            print(f"  警告: {os.path.join(result.save_path, result.file)} 行号超出范围: {lines}")
     
-    return '\n'.join(lines)
+    if summary.previewed:
+        print(f"预览 {summary.previewed} 个（未写入），失败 {summary.failed} 个")
+    else:
+        print(f"成功 {summary.patched} 个，无需修改 {summary.unchanged} 个，"
+              f"失败 {summary.failed} 个")
 
 
-def process_file(file_path, modifications, save_path):
-    """处理单个存档文件（修改模式）"""
-    print(f"\n处理: {file_path}")
-    full_path = os.path.join(save_path, file_path)
+# 单个存档的恢复结果（Patcher.restore 返回）
+#   status: "restored" 已恢复 / "identical" 已与备份一致 / "missing" 没有可用的备份 / "error" 出错
+RestoreResult = namedtuple("RestoreResult", ["save_path", "file", "status", "error"])
+
+
+class Patcher:
+    """供其他程序调用的接口：不输出任何内容，结果以 Results / RestoreResult 返回
+    
+        patcher = Patcher(read_config("drg.json")[0], progress=callback)
+        results = patcher.apply(["saves/*"])
+    
+    config 为 {章节: PatchPlan}（read_config / compile_config 的结果），也可以是原始修改表
+    {章节: {行号或字段名: 新值}}。progress 为可选回调，每处理完一个存档调用一次，
+    参数为 FileResult（apply）或 RestoreResult（restore），可在其中写日志、更新进度条。
+    use_async 为 True 时使用 run_pipeline，否则使用 run_batch；其余参数含义同这两个函数。
+    """
     
-    with open(full_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    def __init__(self, config, progress=None, dry_run=False, workers=1, stream=False, inplace=False,
+                 use_async=False, max_in_flight=32, io_workers=8, vectorize=False):
+        self.config = {chapter: plan if isinstance(plan, PatchPlan) else compile_plan(chapter, plan)
+                       for chapter, plan in config.items() if chapter != "settings"}
+        self.progress = progress
+        self.dry_run = dry_run
+        self.workers = workers
+        self.stream = stream
+        self.inplace = inplace
+        self.use_async = use_async
+        self.max_in_flight = max_in_flight
+        self.io_workers = io_workers
+        self.vectorize = vectorize
     
-    backup_file(file_path, save_path)
+    def apply(self, paths):
+        """修改 paths（存档目录列表，支持通配符）下所有配置章节的存档，返回 Results"""
+        if self.use_async:
+            return run_pipeline(self.config, paths, self.max_in_flight, self.io_workers,
+                                self.dry_run, progress=self.progress)
+        return run_batch(self.config, paths, self.workers, self.dry_run,
+                         self.stream, self.inplace, self.progress, self.vectorize)
     
-    modified_content = content
-    for line_str, new_value in modifications.items():
-        line_number = int(line_str)
-        modified_content = modify_line(modified_content, line_number, new_value)
-        print(f"  第 {line_number} 行 -> {new_value}")
+    def restore(self, paths, generation=-1, workers=None):
+        """从备份恢复 paths 下的所有存档，返回 [RestoreResult, ...]；generation 含义同 restore_backup"""
+        results = []
+        for save_path in expand_save_roots(paths):
+            _, _, tasks, warnings = plan_restore(save_path, generation)
+            done = restore_many(save_path, tasks, workers)
+            finish_restore(save_path, done)
+            
+            for name, warning in warnings:
+                results.append(RestoreResult(save_path, name, "missing", warning))
+                if self.progress is not None:
+                    self.progress(results[-1])
+            for name, status, error in done:
+                results.append(RestoreResult(save_path, name, status, error))
+                if self.progress is not None:
+                    self.progress(results[-1])
+        return results
+
+
+def console_progress(config):
+    """交互模式的进度输出：按章节分组打印每个存档的处理过程，作为 Patcher 的 progress 回调"""
+    current = [None]
     
-    with open(full_path, 'w', encoding='utf-8') as f:
-        f.write(modified_content)
+    def progress(result):
+        if result.chapter != current[0]:
+            current[0] = result.chapter
+            print(f"\n{'='*50}")
+            print(f"章节: {result.chapter}")
+        print(f"\n处理: {result.file}")
+        for line in describe_result(result, config[result.chapter]):
+            print(line)
     
-    print(f"  完成")
+    return progress
 
 
-def restore_all_backups(save_path):
-    """恢复所有备份"""
+def restore_all_backups(save_path, assume_yes=False, generation=-1, workers=None, errors=None):
+    """恢复所有备份，返回成功恢复（含本来就与备份一致）的文件数
+    
+    assume_yes 为 True 时跳过确认；generation 含义同 restore_backup（默认恢复最近一次备份）。
+    传入 errors 列表时，把恢复失败或找不到要恢复的备份版本的 (存档完整路径, 错误信息) 追加进去。
+    先规划好全部恢复任务，再用线程池并行复制（见 restore_many），最后统一输出一次汇总。
+    """
     print(f"\n{'='*50}")
     print("恢复备份模式")
     print(f"存档目录: {save_path}")
     print(f"{'='*50}")
     
-    # 查找所有备份文件
-    backup_files = find_backup_files(save_path)
+    backup_files, history, tasks, warnings = plan_restore(save_path, generation)
     
     if not backup_files:
         print(f"未找到任何备份文件")
-        return False
+        return 0
     
-    print(f"找到 {len(backup_files)} 个备份文件:")
-    for bf in backup_files:
-        print(f"  - {os.path.basename(bf)}")
+    print(f"找到 {len(backup_files)} 个存档的备份:")
+    for original_name in backup_files:
+        generations = history.get(original_name)
+        if generations:
+            print(f"  - {original_name} ({len(generations)} 个版本，最近: {generations[-1]['time']})")
+        else:
+            print(f"  - {original_name}.backup")
     
-    print(f"\n确认恢复所有备份? (输入 yes 确认)")
-    try:
-        confirm = input("> ").strip().lower()
-    except:
-        confirm = ""
+    if not assume_yes:
+        print(f"\n确认恢复所有备份? (输入 yes 确认)")
+        try:
+            confirm = input("> ").strip().lower()
+        except:
+            confirm = ""
+        
+        if confirm != "yes":
+            print("取消恢复")
+            return 0
     
-    if confirm != "yes":
-        print("取消恢复")
-        return False
+    for name, warning in warnings:
+        print(f"  警告: {warning}")
+        if errors is not None:
+            errors.append((os.path.join(save_path, name), warning))
+    
+    results = restore_many(save_path, tasks, workers)
+    finish_restore(save_path, results)
+    restored = sum(1 for _, status, _ in results if status == "restored")
+    identical = sum(1 for _, status, _ in results if status == "identical")
     
-    # 执行恢复
-    restored_count = 0
-    for backup_path in backup_files:
-        original_name = os.path.basename(backup_path).replace(".backup", "")
+    for name, status, error in results:
+        if status == "error":
+            print(f"  错误恢复 {name}: {error}")
+            if errors is not None:
+                errors.append((os.path.join(save_path, name), error))
+    
+    print(f"\n成功恢复 {restored} 个，已与备份一致 {identical} 个，"
+          f"共 {len(backup_files)} 个存档")
+    return restored + identical
+
+
+# 可选的计时与计数：enable_metrics 之后才把下表中的函数换成计时版本，
+# 未开启时调用的是原函数，没有任何额外开销。
+#   函数名 -> (阶段名, 计数函数)；阶段名为 None 表示只计数不计时
+# 阶段可以嵌套（如 backup 包含它写入备份仓库的 write），各阶段耗时是各自的累计值，不能直接相加。
+METRICS = None
+
+
+def _count_read(metrics, args, result):
+    metrics.count("bytes_read", len(result[0]))
+
+
+def _count_stream(metrics, args, result):
+    metrics.count("bytes_read", result[-1].st_size)
+
+
+def _count_inplace(metrics, args, result):
+    edits, _ = result
+    metrics.count("bytes_read", len(args[0]))
+    if edits:
+        metrics.count("bytes_written", sum(len(data) for _, data in edits))
+
+
+def _count_hashed(metrics, args, result):
+    metrics.count("bytes_read", os.path.getsize(args[0]))
+
+
+def _count_replaced(metrics, args, result):
+    # 所有整文件写入（存档、备份、索引、manifest、恢复）最后都经过 _replace_synced
+    metrics.count("bytes_written", os.path.getsize(args[1]))
+
+
+def _count_results(metrics, results):
+    for result in results:
+        metrics.count("errors" if result.status == "error" else f"files_{result.status}")
+
+
+def _count_restores(metrics, args, result):
+    for _, status, _ in result:
+        metrics.count("errors" if status == "error" else f"restores_{status}")
+
+
+_INSTRUMENTED = {
+    "read_config": ("load_config", None),
+    "scan_save_dir": ("find_save_files", None),
+    "_read_bytes": ("read", _count_read),
+    "_file_sha256": ("read", _count_hashed),
+    "_write_backup": ("backup", None),
+    "modify_line": ("modify", None),
+    "apply_plan": ("modify", None),
+    "_locate_inplace_edits": ("modify", _count_inplace),
+    "_vector_modify": ("modify", None),
+    "_stream_patch": ("stream", _count_stream),
+    "atomic_write": ("write", None),
+    "_replace_synced": ("fsync", _count_replaced),
+    "restore_backup": ("restore", None),
+    "_run_restore_task": ("restore", None),
+    "restore_many": (None, _count_restores),
+    "process_file": (None, lambda metrics, args, result: _count_results(metrics, [result])),
+    "_summarize": (None, lambda metrics, args, result: _count_results(metrics, args[1])),
+}
+_ORIGINALS = {}
+
+
+class Metrics:
+    """各阶段耗时（time.perf_counter_ns）和计数器，可在多个线程中同时更新"""
+    
+    def __init__(self):
+        import threading
         
-        try:
-            if restore_backup(original_name, save_path):
-                restored_count += 1
-        except Exception as e:
-            print(f"  错误恢复 {original_name}: {e}")
+        self._lock = threading.Lock()
+        self.spans = {}     # 阶段 -> [调用次数, 总纳秒, 最长一次纳秒]
+        self.counters = {}  # 名称 -> 累计值
     
-    print(f"\n成功恢复 {restored_count}/{len(backup_files)} 个文件")
-    return True
+    def add_span(self, stage, elapsed_ns):
+        with self._lock:
+            span = self.spans.get(stage)
+            if span is None:
+                self.spans[stage] = [1, elapsed_ns, elapsed_ns]
+            else:
+                span[0] += 1
+                span[1] += elapsed_ns
+                span[2] = max(span[2], elapsed_ns)
+    
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.counters.clear()
+    
+    def snapshot(self):
+        """可 pickle 的当前统计，用于从子进程传回"""
+        with self._lock:
+            return {stage: list(span) for stage, span in self.spans.items()}, dict(self.counters)
+    
+    def merge(self, snapshot):
+        """合并另一个 Metrics 的 snapshot"""
+        spans, counters = snapshot
+        with self._lock:
+            for stage, (calls, total, longest) in spans.items():
+                span = self.spans.setdefault(stage, [0, 0, 0])
+                span[0] += calls
+                span[1] += total
+                span[2] = max(span[2], longest)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+    
+    def to_dict(self):
+        """JSON 格式的汇总"""
+        spans, counters = self.snapshot()
+        return {
+            "spans": {
+                stage: {"calls": calls, "total_ms": round(total / 1e6, 3), "max_ms": round(longest / 1e6, 3)}
+                for stage, (calls, total, longest) in sorted(spans.items())
+            },
+            "counters": dict(sorted(counters.items())),
+        }
+    
+    def to_prometheus(self, prefix="drg"):
+        """Prometheus 文本格式的汇总"""
+        spans, counters = self.snapshot()
+        lines = []
+        for metric, kind, column, scale in (("stage_calls_total", "counter", 0, 1),
+                                            ("stage_seconds_total", "counter", 1, 1e9),
+                                            ("stage_max_seconds", "gauge", 2, 1e9)):
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for stage, span in sorted(spans.items()):
+                value = span[column] if scale == 1 else f"{span[column] / scale:.9f}"
+                lines.append(f'{prefix}_{metric}{{stage="{stage}"}} {value}')
+        for name, value in sorted(counters.items()):
+            metric = f"{prefix}_{name.replace('-', '_')}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _instrument(func, stage, counter):
+    from functools import wraps
+    
+    perf_counter_ns = time.perf_counter_ns
+    
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if stage is None:
+            result = func(*args, **kwargs)
+        else:
+            start = perf_counter_ns()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                METRICS.add_span(stage, perf_counter_ns() - start)
+        if counter is not None:
+            counter(METRICS, args, result)
+        return result
+    return wrapper
+
+
+def enable_metrics():
+    """开启计时与计数，返回 Metrics；已开启时直接返回当前的 Metrics"""
+    global METRICS
+    if METRICS is not None:
+        return METRICS
+    
+    METRICS = Metrics()
+    module = globals()
+    for name, (stage, counter) in _INSTRUMENTED.items():
+        _ORIGINALS[name] = module[name]
+        module[name] = _instrument(module[name], stage, counter)
+    return METRICS
+
+
+def disable_metrics():
+    """关闭计时与计数，换回原函数，返回关闭前的 Metrics（未开启时返回 None）"""
+    global METRICS
+    metrics, METRICS = METRICS, None
+    globals().update(_ORIGINALS)
+    _ORIGINALS.clear()
+    return metrics
+
+
+def write_metrics(metrics, path, fmt="json", out=None):
+    """把统计写到文件，path 为 - 时写到 out（默认标准输出）"""
+    if fmt == "prometheus":
+        text = metrics.to_prometheus()
+    else:
+        text = json.dumps(metrics.to_dict(), ensure_ascii=False, indent=2) + "\n"
+    
+    if path == "-":
+        (out or sys.stdout).write(text)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
 
 
 def main():
@@ -291,24 +2470,13 @@ def main():
         input("\n按回车退出...")
         return
     
-    # 处理每个章节
-    for chapter_key, modifications in config.items():
-        print(f"\n{'='*50}")
-        print(f"章节: {chapter_key}")
-        
-        save_files, actual_path = find_save_files(chapter_key, save_path)
-        
-        if not save_files:
-            print(f"  未找到 {chapter_key}_* 存档文件")
-            continue
-        
-        print(f"  找到 {len(save_files)} 个: {', '.join(save_files)}")
-        
-        for save_file in save_files:
-            try:
-                process_file(save_file, modifications, actual_path)
-            except Exception as e:
-                print(f"  错误: {e}")
+    # 存档目录按字面路径处理，不展开通配符
+    summary = Patcher(config, progress=console_progress(config)).apply([glob.escape(save_path)])
+    
+    found = {result.chapter for result in summary.results}
+    for chapter_key in config:
+        if chapter_key not in found:
+            print(f"\n  未找到 {chapter_key}_* 存档文件")
     
     print(f"\n{'='*50}")
     print("所有修改完成！")
@@ -316,5 +2484,207 @@ def main():
     input("按回车退出...")
 
 
+# 命令行模式退出码
+EXIT_OK = 0          # 全部存档修改/恢复成功
+EXIT_FAILED = 1      # 至少一个存档处理失败
+EXIT_USAGE = 2       # 参数或配置错误（与 argparse 一致）
+EXIT_NOTHING = 3     # 没有找到任何需要处理的存档或备份
+
+
+def _non_negative_int(text):
+    """argparse 类型：不小于 0 的整数"""
+    import argparse
+    
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"不是整数: {text!r}") from None
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"不能小于 0: {value}")
+    return value
+
+
+def build_arg_parser():
+    """命令行参数定义"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(
+        prog="drg",
+        description="Deltarune 存档修改器（命令行模式，不带参数运行时进入交互模式）",
+        epilog="退出码: 0 全部成功，1 有存档失败，2 参数或配置错误，3 未找到存档或备份",
+    )
+    parser.add_argument("--config", help="配置文件路径（默认: 程序目录下的 drg.json）")
+    parser.add_argument("--save-path", action="append", dest="save_paths", metavar="PATH",
+                        help="存档目录，可重复指定，支持通配符（默认: 配置中的 settings.save_path）")
+    parser.add_argument("--restore", action="store_true", help="从备份恢复存档，而不是修改")
+    parser.add_argument("--yes", action="store_true", help="恢复备份时不再确认（命令行模式下恢复必须指定）")
+    parser.add_argument("--generation", type=int, default=-1, metavar="N",
+                        help="恢复哪一版备份：-1 最近一次（默认），0 最早的原始存档，-2 倒数第二次，以此类推")
+    parser.add_argument("--quiet", action="store_true", help="只输出错误信息")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="只预览修改，不写存档和备份；把逐行差异以 JSON 输出到 --report")
+    parser.add_argument("--report", default="-", metavar="FILE",
+                        help="--dry-run 报告的输出文件，- 表示标准输出（默认: -）")
+    parser.add_argument("--stream", action="store_true",
+                        help="逐行流式修改，不把整个存档读入内存（适合很大的存档）")
+    parser.add_argument("--async", action="store_true", dest="use_async",
+                        help="使用异步流水线（适合慢速或网络文件系统），不能与 --stream/--inplace 同用")
+    parser.add_argument("--in-flight", type=int, default=32, metavar="N",
+                        help="--async 时同时处理中的存档上限（默认: 32）")
+    parser.add_argument("--io-threads", type=int, default=8, metavar="N",
+                        help="--async 时执行文件操作的线程数（默认: 8）")
+    parser.add_argument("--inplace", action="store_true",
+                        help="替换前后宽度相同时用 mmap 原地改写，宽度不同的存档自动改为整文件重写")
+    parser.add_argument("--vectorize", action="store_true",
+                        help="同一章节的存档成批读入、一次定位全部目标行后批量修改（存档很多时更快，"
+                             "已安装 NumPy 时使用 NumPy），不能与 --stream/--inplace/--async 同用")
+    parser.add_argument("--workers", type=_non_negative_int, default=None, metavar="N",
+                        help="并行数：批量修改时为进程数（默认 1），恢复备份时为线程数（默认自动）；"
+                             "0 表示按 CPU 核数自动选择")
+    parser.add_argument("--watch", action="store_true",
+                        help="常驻监视存档目录，游戏写入存档后自动重新修改（Ctrl+C 退出）")
+    parser.add_argument("--interval", type=float, default=1.0, metavar="SECONDS",
+                        help="--watch 时检查存档的间隔秒数（默认: 1）")
+    parser.add_argument("--settle", type=float, default=0.5, metavar="SECONDS",
+                        help="--watch 时存档连续多少秒不再变化才处理（默认: 0.5）")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="记录各阶段耗时和读写字节数等计数，结束后写到 FILE，- 表示标准输出")
+    parser.add_argument("--metrics-format", choices=("json", "prometheus"), default="json",
+                        help="--metrics 的输出格式（默认: json）")
+    return parser
+
+
+def cli(argv):
+    """命令行模式：不弹窗、不等待输入，返回退出码"""
+    args = build_arg_parser().parse_args(argv)
+    out = sys.stdout
+    
+    if args.metrics:
+        enable_metrics()
+    try:
+        if args.quiet:
+            with open(os.devnull, 'w') as devnull:
+                sys.stdout = devnull
+                try:
+                    return _run_cli(args, out)
+                finally:
+                    sys.stdout = out
+        return _run_cli(args, out)
+    finally:
+        if args.metrics:
+            write_metrics(disable_metrics(), args.metrics, args.metrics_format, out)
+
+
+def _print_watch_result(result):
+    """--watch 时每处理一个存档输出一行，错误输出到 stderr（--quiet 时也会输出）"""
+    path = os.path.join(result.save_path, result.file)
+    stamp = time.strftime("%H:%M:%S")
+    if result.status == "error":
+        print(f"{stamp} 错误: {path}: {result.error}", file=sys.stderr)
+    elif result.status == "patched":
+        print(f"{stamp} 已修改: {path}")
+    else:
+        print(f"{stamp} 已是目标值: {path}")
+
+
+def _run_cli(args, out):
+    """out 是未被 --quiet 屏蔽的标准输出，用于输出机器可读的报告"""
+    config_path = args.config or os.path.join(EXE_DIR, "drg.json")
+    
+    if args.restore:
+        if not args.yes:
+            print("错误: 命令行模式下恢复备份需要同时指定 --yes", file=sys.stderr)
+            return EXIT_USAGE
+        
+        if args.save_paths:
+            save_roots = expand_save_roots(args.save_paths)
+        elif args.config is not None or os.path.exists(config_path):
+            try:
+                save_roots = [read_save_path(config_path)]
+            except Exception as e:
+                print(f"错误: 无法加载配置文件 {config_path}: {e}", file=sys.stderr)
+                return EXIT_USAGE
+        else:
+            # 与交互模式一致：没有配置时恢复程序目录下的备份
+            save_roots = [EXE_DIR]
+        
+        errors = []
+        restored = sum(restore_all_backups(save_path, assume_yes=True, generation=args.generation,
+                                           workers=args.workers or None, errors=errors)
+                       for save_path in save_roots)
+        if args.quiet:
+            # 恢复过程的输出被屏蔽，错误单独输出到 stderr
+            for path, error in errors:
+                print(f"错误: {path}: {error}", file=sys.stderr)
+        if errors:
+            return EXIT_FAILED
+        return EXIT_OK if restored else EXIT_NOTHING
+    
+    try:
+        config, save_path = read_config(config_path)
+    except Exception as e:
+        print(f"错误: 无法加载配置文件 {config_path}: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    
+    if args.use_async and (args.stream or args.inplace):
+        print("错误: --async 不能与 --stream/--inplace 同时使用", file=sys.stderr)
+        return EXIT_USAGE
+    
+    if args.vectorize and (args.stream or args.inplace or args.use_async or args.watch):
+        print("错误: --vectorize 不能与 --stream/--inplace/--async/--watch 同时使用", file=sys.stderr)
+        return EXIT_USAGE
+    
+    # 只有 --save-path 支持通配符，配置中的存档目录按字面路径处理（与交互模式一致）
+    roots = args.save_paths or [glob.escape(save_path)]
+    
+    if args.watch:
+        if args.dry_run or args.use_async:
+            print("错误: --watch 不能与 --dry-run/--async 同时使用", file=sys.stderr)
+            return EXIT_USAGE
+        print(f"监视中: {', '.join(args.save_paths or [save_path])}（Ctrl+C 退出）")
+        try:
+            watch(config, roots, interval=max(0.05, args.interval), settle=max(0.0, args.settle),
+                  stream=args.stream, inplace=args.inplace, progress=_print_watch_result)
+        except KeyboardInterrupt:
+            print("已停止监视")
+        return EXIT_OK
+    
+    patcher = Patcher(config, dry_run=args.dry_run,
+                      workers=1 if args.workers is None else args.workers or None,
+                      stream=args.stream, inplace=args.inplace, use_async=args.use_async,
+                      max_in_flight=max(1, args.in_flight), io_workers=max(1, args.io_threads),
+                      vectorize=args.vectorize)
+    summary = patcher.apply(roots)
+    
+    if args.dry_run:
+        report = json.dumps(dry_run_report(summary), ensure_ascii=False, indent=2)
+        if args.report == "-":
+            # --quiet 只屏蔽提示文字，报告仍写到标准输出
+            out.write(report + "\n")
+        else:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                f.write(report + "\n")
+    else:
+        print_batch_summary(summary)
+    
+    if args.quiet:
+        # 汇总被屏蔽，错误单独输出到 stderr
+        for result in summary.results:
+            if result.status == "error":
+                print(f"错误: {os.path.join(result.save_path, result.file)}: {result.error}",
+                      file=sys.stderr)
+    
+    if summary.failed:
+        return EXIT_FAILED
+    return EXIT_OK if summary.results else EXIT_NOTHING
+
+
 if __name__ == "__main__":
+    if getattr(sys, 'frozen', False):
+        # PyInstaller 打包后，批量模式的进程池子进程需要这一步才能正常启动
+        import multiprocessing
+        multiprocessing.freeze_support()
+    
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()
@@ -0,0 +1,125 @@
+"""配置文件选择器：找不到 drg.json 时由 drg.select_file_dialog 按需导入，平时启动不加载
+
+选择器是一个函数 picker(title, patterns) -> 所选文件路径，取消时返回 None；
+patterns 为 ((说明, 通配符), ...)，如 (("JSON文件", "*.json"), ("所有文件", "*.*"))。
+    windows   Windows 文件选择对话框（ctypes 调用 comdlg32，只在 Windows 下可用）
+    terminal  在终端中输入路径
+    none      不选择，直接返回 None（脚本或无终端环境）
+默认按平台选择，也可以用环境变量 DRG_PICKER 指定。
+"""
+import os
+import sys
+from functools import lru_cache
+
+# Windows API 常量
+OFN_FILEMUSTEXIST = 0x00001000
+OFN_NOCHANGEDIR = 0x00000008
+
+
+@lru_cache(maxsize=None)
+def _openfilename_type():
+    """OPENFILENAME 结构（第一次弹窗时才定义）"""
+    import ctypes
+    from ctypes import wintypes
+    
+    class OPENFILENAME(ctypes.Structure):
+        _fields_ = [
+            ("lStructSize", wintypes.DWORD),
+            ("hwndOwner", wintypes.HWND),
+            ("hInstance", wintypes.HINSTANCE),
+            ("lpstrFilter", wintypes.LPCWSTR),
+            ("lpstrCustomFilter", wintypes.LPWSTR),
+            ("nMaxCustFilter", wintypes.DWORD),
+            ("nFilterIndex", wintypes.DWORD),
+            ("lpstrFile", wintypes.LPWSTR),
+            ("nMaxFile", wintypes.DWORD),
+            ("lpstrFileTitle", wintypes.LPWSTR),
+            ("nMaxFileTitle", wintypes.DWORD),
+            ("lpstrInitialDir", wintypes.LPCWSTR),
+            ("lpstrTitle", wintypes.LPCWSTR),
+            ("Flags", wintypes.DWORD),
+            ("nFileOffset", wintypes.WORD),
+            ("nFileExtension", wintypes.WORD),
+            ("lpstrDefExt", wintypes.LPCWSTR),
+            ("lCustData", wintypes.LPARAM),
+            ("lpfnHook", wintypes.LPVOID),
+            ("lpTemplateName", wintypes.LPCWSTR),
+            ("pvReserved", wintypes.LPVOID),
+            ("dwReserved", wintypes.DWORD),
+            ("FlagsEx", wintypes.DWORD),
+        ]
+    
+    return OPENFILENAME
+
+
+def windows_picker(title, patterns):
+    """使用 Windows API 弹出文件选择对话框"""
+    if os.name != 'nt':
+        raise OSError("Windows 文件选择对话框只能在 Windows 下使用")
+    
+    import ctypes
+    from ctypes import wintypes
+    
+    OPENFILENAME = _openfilename_type()
+    buffer_size = 260
+    file_buffer = ctypes.create_unicode_buffer(buffer_size)
+    filter_text = "".join(f"{label}\0{pattern}\0" for label, pattern in patterns) + "\0"
+    
+    ofn = OPENFILENAME()
+    ofn.lStructSize = ctypes.sizeof(OPENFILENAME)
+    ofn.hwndOwner = None
+    ofn.lpstrFilter = filter_text
+    ofn.lpstrFile = ctypes.cast(file_buffer, wintypes.LPWSTR)
+    ofn.nMaxFile = buffer_size
+    ofn.lpstrTitle = title
+    ofn.Flags = OFN_FILEMUSTEXIST | OFN_NOCHANGEDIR
+    
+    comdlg32 = ctypes.windll.comdlg32
+    result = comdlg32.GetOpenFileNameW(ctypes.byref(ofn))
+    
+    if result:
+        return file_buffer.value
+    return None
+
+
+def terminal_picker(title, patterns):
+    """在终端中输入文件路径，直接回车表示取消"""
+    print(f"{title}（{', '.join(pattern for _, pattern in patterns)}），直接回车取消:")
+    try:
+        path = input("> ").strip().strip('"')
+    except (EOFError, KeyboardInterrupt):
+        return None
+    return os.path.expanduser(path) if path else None
+
+
+def no_picker(title, patterns):
+    """不选择文件"""
+    return None
+
+
+PICKERS = {
+    "windows": windows_picker,
+    "terminal": terminal_picker,
+    "none": no_picker,
+}
+
+
+def default_picker_name():
+    """DRG_PICKER 环境变量优先；否则 Windows 用对话框，有终端时输入路径，都没有时不选择"""
+    name = os.environ.get("DRG_PICKER")
+    if name:
+        return name
+    if os.name == 'nt':
+        return "windows"
+    if sys.stdin is not None and sys.stdin.isatty():
+        return "terminal"
+    return "none"
+
+
+def get_picker(name=None):
+    """按名称取选择器，name 为 None 时按 default_picker_name 选择"""
+    name = name or default_picker_name()
+    try:
+        return PICKERS[name]
+    except KeyError:
+        raise ValueError(f"未知的文件选择器: {name}（可选: {', '.join(PICKERS)}）") from None